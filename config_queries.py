@@ -9,7 +9,7 @@ from handlers import Expunge
 from handlers import Move
 from handlers import Obnoxious
 from handlers import Proxy
-from handlers import SetFlags
+from handlers import SetFlagsAndMoveAndExpunge
 from handlers import WorkEmail
 from query_dsl import AllOf
 from query_dsl import AnyOf
@@ -18,26 +18,27 @@ from query_dsl import Froms
 from query_dsl import Match
 from query_dsl import Not
 from query_dsl import Tos
+from query_dsl import compile_queries
 
 Queries = [
     # Work emails: auto-reply and forward
     (
         Match(AnyOf(Froms(*config.work_senders))),
-        [WorkEmail(config), SetFlags(r"(\Seen)"), Move("INBOX.Arbeit"), Expunge()],
+        [WorkEmail(config), SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Arbeit")],
     ),
     # Newsletters: defer to later
     (Match(AnyOf(Tos(*config.newsletters))), [Move("INBOX.Later"), Expunge()]),
     # Received only for the Record: move and mark read
     (
         Match(AnyOf(Tos(*config.for_the_record_only))),
-        [SetFlags(r"(\Seen)"), Move("INBOX.Read"), Expunge()],
+        [SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")],
     ),
     # Obnoxious senders: delete and send snarky reply
     (Match(AnyOf(Froms(*config.obnoxious_senders))), [Obnoxious(config)]),
     # Proxy: fetch URLs from email and convert to readable format
     (
         Match(AllOf(Froms(config.mydomain), Tos(config.proxy_to))),
-        [Proxy(config), SetFlags(r"(\Seen)"), Move("INBOX.Read"), Expunge()],
+        [Proxy(config), SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")],
     ),
     # Emails from self without explicit recipients: hints folder
     (
@@ -47,11 +48,14 @@ Queries = [
                 AnyOf(Tos(config.mydomain), Not(AnyOf(Tos("@"), Ccs("@")))),
             )
         ),
-        [SetFlags(r"(\Seen)"), Move("INBOX.Hints"), Expunge()],
+        [SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Hints")],
     ),
     # Other emails from self: mark read
     (
         Match(AnyOf(Froms(config.mydomain))),
-        [SetFlags(r"(\Seen)"), Move("INBOX.Read"), Expunge()],
+        [SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")],
     ),
 ]
+
+# Compile once at import; runQueries walks these on every IDLE wakeup
+Queries = compile_queries(Queries)
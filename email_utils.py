@@ -4,35 +4,101 @@ Email utilities: parsing, construction, language detection, SMTP sending.
 Uses the modern EmailMessage API (Python 3.6+).
 """
 
+import collections
+import contextlib
+import copy
 import email
 import email.message
+import email.parser
 import email.policy
 import email.utils
+import re
 import smtplib
 
-
 EMAIL_POLICY = email.policy.EmailPolicy(utf8=True)
 
+_HEADER_PARSER = email.parser.BytesHeaderParser(policy=EMAIL_POLICY)
+_HEADER_END = re.compile(rb"\r?\n\r?\n")
+
 
 # ============================================================================
 # Message deduplication
 # ============================================================================
 
 
+class SeenIds:
+    """
+    Size-capped LRU set of Message-IDs.
+    Re-adding an ID marks it as recently seen; once more than maxlen IDs
+    are recorded the least recently seen are forgotten, so a long-running
+    daemon keeps a bounded dedup window.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self._ids = collections.OrderedDict()
+
+    def __contains__(self, message_id):
+        return message_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def add(self, message_id):
+        ids = self._ids
+        if message_id in ids:
+            ids.move_to_end(message_id)
+            return
+        ids[message_id] = None
+        if len(ids) > self.maxlen:
+            ids.popitem(last=False)
+
+
 def should_process_message(message_id, seen_ids):
     """
     Check if message should be processed based on Message-ID deduplication.
+    Records the Message-ID in seen_ids (in place) when it is new, as a
+    plain str so parsed header objects are not kept alive.
 
     Args:
         message_id: The Message-ID header value
-        seen_ids: Set of already processed message IDs
+        seen_ids: Set or SeenIds of already processed message IDs (mutated)
 
     Returns:
-        (should_process, updated_seen_ids) tuple
+        True if the message has not been seen before
     """
+    if message_id is not None:
+        message_id = str(message_id)
     if message_id in seen_ids:
-        return False, seen_ids
-    return True, seen_ids | {message_id}
+        # Refresh recency so IDs that keep arriving stay in a SeenIds window
+        seen_ids.add(message_id)
+        return False
+    seen_ids.add(message_id)
+    return True
+
+
+# ============================================================================
+# Header parsing
+# ============================================================================
+
+
+def parse_headers(raw):
+    """
+    Parse only the header block of a raw RFC822 message.
+    Everything after the first blank line is never handed to the parser,
+    so reading a few headers costs the same for large and small messages.
+
+    Args:
+        raw: Message bytes as fetched from IMAP
+
+    Returns:
+        EmailMessage holding the headers (and no body)
+    """
+    end = _HEADER_END.search(raw)
+    return _HEADER_PARSER.parsebytes(raw[: end.end()] if end else raw)
 
 
 # ============================================================================
@@ -52,12 +118,12 @@ def detect_language(email_message, available_languages, default="en"):
     Returns:
         Language code (e.g., "de", "en")
     """
-    content_lang = email_message.get("Content-Language", "")
-    for lang in available_languages:
-        if lang in content_lang.lower():
-            return lang
+    content_lang = email_message.get("Content-Language")
+    if not content_lang:
+        return default
 
-    return default
+    content_lang = content_lang.lower()
+    return next((lang for lang in available_languages if lang in content_lang), default)
 
 
 # ============================================================================
@@ -65,6 +131,40 @@ def detect_language(email_message, available_languages, default="en"):
 # ============================================================================
 
 
+def _set_envelope_headers(
+    msg,
+    *,
+    subject,
+    from_addr,
+    to_addr,
+    subject_prefix=None,
+    in_reply_to=None,
+    reply_to=None,
+    message_id=None,
+    message_id_domain=None,
+):
+    """Add the addressing headers shared by build_message and stamp_reply"""
+    msg["Subject"] = f"{subject_prefix} {subject}" if subject_prefix else subject
+    msg["From"] = from_addr
+    msg["To"] = to_addr
+
+    if reply_to:
+        msg["Reply-To"] = reply_to
+
+    if message_id:
+        msg["Message-ID"] = message_id
+    elif message_id_domain:
+        msg["Message-ID"] = email.utils.make_msgid(domain=message_id_domain)
+    else:
+        msg["Message-ID"] = email.utils.make_msgid()
+
+    msg["Date"] = email.utils.formatdate(localtime=True)
+
+    if in_reply_to:
+        msg["In-Reply-To"] = in_reply_to
+        msg["References"] = in_reply_to
+
+
 def build_message(
     *,
     subject,
@@ -104,28 +204,18 @@ def build_message(
     Returns:
         EmailMessage object
     """
-    msg_subject = f"{subject_prefix} {subject}" if subject_prefix else subject
-
     msg = email.message.EmailMessage(policy=EMAIL_POLICY)
-    msg["Subject"] = msg_subject
-    msg["From"] = from_addr
-    msg["To"] = to_addr
-
-    if reply_to:
-        msg["Reply-To"] = reply_to
-
-    if message_id:
-        msg["Message-ID"] = message_id
-    elif message_id_domain:
-        msg["Message-ID"] = email.utils.make_msgid(domain=message_id_domain)
-    else:
-        msg["Message-ID"] = email.utils.make_msgid()
-
-    msg["Date"] = email.utils.formatdate(localtime=True)
-
-    if in_reply_to:
-        msg["In-Reply-To"] = in_reply_to
-        msg["References"] = in_reply_to
+    _set_envelope_headers(
+        msg,
+        subject=subject,
+        from_addr=from_addr,
+        to_addr=to_addr,
+        subject_prefix=subject_prefix,
+        in_reply_to=in_reply_to,
+        reply_to=reply_to,
+        message_id=message_id,
+        message_id_domain=message_id_domain,
+    )
 
     msg.set_content(body)
 
@@ -150,29 +240,163 @@ def build_message(
     return msg
 
 
+def build_reply_template(*, from_addr, body, reply_to=None):
+    """
+    Build the constant part of an auto-reply once: sender, Reply-To and
+    the encoded body. Use stamp_reply to turn it into a sendable message.
+
+    Args:
+        from_addr: Sender address
+        body: Message body (string)
+        reply_to: Optional Reply-To address
+
+    Returns:
+        EmailMessage template (not meant to be sent as is)
+    """
+    msg = email.message.EmailMessage(policy=EMAIL_POLICY)
+    msg["From"] = from_addr
+    if reply_to:
+        msg["Reply-To"] = reply_to
+    msg.set_content(body)
+    return msg
+
+
+def stamp_reply(
+    template,
+    *,
+    subject,
+    to_addr,
+    subject_prefix=None,
+    in_reply_to=None,
+    message_id_domain=None,
+):
+    """
+    Build a message from a build_reply_template result plus the per-message
+    headers. Equivalent to build_message with the same arguments, but the
+    template's headers are reused already parsed and its body is copied
+    rather than re-encoded.
+
+    Args:
+        template: EmailMessage from build_reply_template (left unchanged)
+        subject: Email subject
+        to_addr: Recipient address
+        subject_prefix: Optional prefix ('Re:', 'Fwd:', etc.)
+        in_reply_to: Optional Message-ID being replied to
+        message_id_domain: Optional domain for Message-ID generation
+
+    Returns:
+        EmailMessage object
+    """
+    # The copy keeps the body exactly as the template encoded it
+    msg = copy.deepcopy(template)
+    content_headers = [
+        (name, value)
+        for name, value in template.raw_items()
+        if name not in ("From", "Reply-To")
+    ]
+    # Re-add every header below, in the order build_message writes them
+    for name in set(msg.keys()):
+        del msg[name]
+
+    # Header objects from the template are stored without being re-parsed
+    _set_envelope_headers(
+        msg,
+        subject=subject,
+        from_addr=template["From"],
+        to_addr=to_addr,
+        subject_prefix=subject_prefix,
+        in_reply_to=in_reply_to,
+        reply_to=template["Reply-To"],
+        message_id_domain=message_id_domain,
+    )
+    for name, value in content_headers:
+        msg[name] = value
+
+    return msg
+
+
 # ============================================================================
 # SMTP sending
 # ============================================================================
 
 
+def smtp_connect(options):
+    """
+    Open an authenticated SMTP connection.
+
+    Args:
+        options: Dict with smtp_server, smtp_user, smtp_pass
+
+    Returns:
+        Logged-in SMTP_SSL connection
+    """
+    smtp_connection = smtplib.SMTP_SSL(options["smtp_server"])
+    smtp_connection.login(options["smtp_user"], options["smtp_pass"])
+    return smtp_connection
+
+
+@contextlib.contextmanager
+def smtp_session(options):
+    """
+    Share one SMTP connection across all sends in a batch.
+
+    Yields a copy of options that send_via_smtp recognizes. The connection
+    is opened on the first send (nothing is opened if nothing is sent),
+    re-opened if the server dropped it, and closed when the batch ends.
+
+    Args:
+        options: Dict with smtp_server, smtp_user, smtp_pass
+    """
+    session = {"connection": None}
+    try:
+        yield {**options, "smtp_session": session}
+    finally:
+        if session["connection"] is not None:
+            try:
+                session["connection"].quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+
+def _session_connection(options, session):
+    """Return the session's live connection, reconnecting if needed"""
+    smtp_connection = session["connection"]
+    if smtp_connection is not None:
+        try:
+            if smtp_connection.noop()[0] == 250:
+                return smtp_connection
+        except (smtplib.SMTPException, OSError):
+            pass
+    smtp_connection = session["connection"] = smtp_connect(options)
+    return smtp_connection
+
+
 def send_via_smtp(options, from_addr, to_addr, message):
     """
     Send message via SMTP with connection handling.
+    Reuses the connection of an enclosing smtp_session, otherwise
+    opens and closes a connection for this message.
 
     Args:
         options: Dict with smtp_server, smtp_user, smtp_pass
+                 (and smtp_session when called inside smtp_session)
         from_addr: Sender address
         to_addr: Recipient address (or list)
         message: EmailMessage object or string or bytes
     """
-    smtp_connection = smtplib.SMTP_SSL(options["smtp_server"])
-    smtp_connection.login(options["smtp_user"], options["smtp_pass"])
+    match message:
+        case str() | bytes():
+            msg_data = message
+        case _:
+            msg_data = message.as_bytes()
+
+    session = options.get("smtp_session")
+    if session is not None:
+        _session_connection(options, session).sendmail(from_addr, to_addr, msg_data)
+        return
+
+    smtp_connection = smtp_connect(options)
     try:
-        match message:
-            case str() | bytes():
-                msg_data = message
-            case _:
-                msg_data = message.as_bytes()
         smtp_connection.sendmail(from_addr, to_addr, msg_data)
     finally:
         smtp_connection.quit()
@@ -200,7 +424,8 @@ def decode_part(part):
 
         charset = part.get_content_charset() or "utf-8"
 
-        for encoding in [charset, "utf-8", "iso-8859-1"]:
+        # dict.fromkeys drops the repeat when the declared charset is a fallback
+        for encoding in dict.fromkeys((charset, "utf-8", "iso-8859-1")):
             try:
                 return payload.decode(encoding)
             except (UnicodeDecodeError, LookupError):
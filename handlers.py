@@ -14,6 +14,41 @@ import imap_utils
 import proxy_utils
 
 
+def uid_set(listofuids, options):
+    """
+    Comma-joined UID set for IMAP UID commands.
+    Uses the set precomputed by runQueries when present.
+    """
+    return options.get("uid_set") or b",".join(listofuids)
+
+
+def fetch_unseen(server, listofuids, options, seen_ids):
+    """
+    Fetch full RFC822 data only for messages not yet in seen_ids.
+    Message-IDs are peeked first, so already-processed duplicates never
+    transfer their bodies. If any header response lacks a UID, falls
+    back to fetching every message; duplicates are then skipped by the
+    Message-ID check in the handler.
+
+    Returns:
+        (res, data) as returned by UID FETCH RFC822
+    """
+    res, headers = imap_utils.fetch_headers(
+        server, uid_set(listofuids, options), ("MESSAGE-ID",)
+    )
+    if res != "OK":
+        return res, headers
+
+    if any(uid is None for uid, _ in headers):
+        print("Warning: FETCH response without UID, fetching all messages")
+        return server.uid("FETCH", uid_set(listofuids, options), "RFC822")
+
+    unseen = [uid for uid, hdrs in headers if hdrs["Message-ID"] not in seen_ids]
+    if not unseen:
+        return res, []
+    return server.uid("FETCH", b",".join(unseen), "RFC822")
+
+
 def Expunge():
     """Factory: Create handler that permanently removes deleted messages"""
 
@@ -28,7 +63,7 @@ def Delete():
     """Factory: Create handler that marks messages as deleted"""
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
+        theuids = uid_set(listofuids, options)
         res, data = server.uid("STORE", theuids, "+FLAGS", r"(\Deleted)")
         return (res, data, seen_ids)
 
@@ -39,7 +74,7 @@ def Copy(folder):
     """Factory: Create handler that copies messages to folder"""
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
+        theuids = uid_set(listofuids, options)
         res, data = server.uid("COPY", theuids, folder)
         return (res, data, seen_ids)
 
@@ -47,11 +82,20 @@ def Copy(folder):
 
 
 def Move(folder):
-    """Factory: Create handler that moves messages (copy + delete)"""
+    """
+    Factory: Create handler that moves messages.
+    Uses a single UID MOVE (RFC 6851) when the server supports it,
+    otherwise falls back to copy + delete.
+    """
     copy_handler = Copy(folder)
     delete_handler = Delete()
 
     def handler(server, listofuids, options, seen_ids):
+        if imap_utils.has_capability(server, "MOVE"):
+            theuids = uid_set(listofuids, options)
+            res, data = server.uid("MOVE", theuids, folder)
+            return (res, data, seen_ids)
+
         res, data, seen_ids = copy_handler(server, listofuids, options, seen_ids)
         if res == "OK":
             return delete_handler(server, listofuids, options, seen_ids)
@@ -64,7 +108,7 @@ def SetFlags(flag):
     """Factory: Create handler that sets IMAP flags on messages"""
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
+        theuids = uid_set(listofuids, options)
         res, data = server.uid("STORE", theuids, "+FLAGS", flag)
         return (res, data, seen_ids)
 
@@ -85,6 +129,27 @@ def SetFlagsAndMove(flag, folder):
     return handler
 
 
+def SetFlagsAndMoveAndExpunge(flag, folder):
+    """
+    Factory: Create handler that sets flags, moves messages and expunges.
+    Expunge is skipped when the server supports UID MOVE, which already
+    removes the source messages. Relies on the capabilities read after
+    login (imap_utils.connect_and_select refreshes them).
+    """
+    set_flags_and_move_handler = SetFlagsAndMove(flag, folder)
+    expunge_handler = Expunge()
+
+    def handler(server, listofuids, options, seen_ids):
+        res, data, seen_ids = set_flags_and_move_handler(
+            server, listofuids, options, seen_ids
+        )
+        if res == "OK" and not imap_utils.has_capability(server, "MOVE"):
+            return expunge_handler(server, listofuids, options, seen_ids)
+        return (res, data, seen_ids)
+
+    return handler
+
+
 def WorkEmail(config, send_fn=None):
     """
     Factory: Create handler that auto-forwards work-related emails with reply to sender.
@@ -99,54 +164,61 @@ def WorkEmail(config, send_fn=None):
                  Defaults to email_utils.send_via_smtp
     """
     send_fn = send_fn or email_utils.send_via_smtp
+    should_process = email_utils.should_process_message
+    detect_language = email_utils.detect_language
+    build_message = email_utils.build_message
+    stamp_reply = email_utils.stamp_reply
+    default_note = config.work_forward_note["en"]
+    # Sender, Reply-To and encoded body are the same for every reply
+    templates = {
+        lang: (
+            email_utils.build_reply_template(
+                from_addr=config.work_reply_from,
+                body=reply,
+                reply_to=config.work_forward_to,
+            ),
+            config.work_forward_note.get(lang, default_note),
+        )
+        for lang, reply in config.work_reply.items()
+    }
+    reply_langs = tuple(templates)
+    default_templates = templates["en"]
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
-        res, data = server.uid("FETCH", theuids, "RFC822")
-
-        for ret in data:
-            if isinstance(ret, (list, tuple)):
-                try:
-                    message = ret[1]
-                except IndexError:
-                    continue
+        res, data = fetch_unseen(server, listofuids, options, seen_ids)
 
-                themail = email.message_from_string(message.decode("utf-8"))
+        with email_utils.smtp_session(options) as smtp_options:
+            for message in imap_utils.iter_rfc822(data):
+                themail = email.message_from_bytes(
+                    message, policy=email_utils.EMAIL_POLICY
+                )
                 if not themail:
                     continue
 
-                should_process, seen_ids = email_utils.should_process_message(
-                    themail["Message-ID"], seen_ids
-                )
-                if not should_process:
+                get = themail.get
+                themid = get("Message-ID")
+                if not should_process(themid, seen_ids):
                     continue
 
-                themid = themail["Message-ID"]
-                thesender = themail["Reply-To"] or themail["From"] or themail["Sender"]
-                subject = themail["Subject"]
+                thesender = get("Reply-To") or get("From") or get("Sender")
+                subject = get("Subject")
 
-                lang = email_utils.detect_language(
-                    themail, config.work_reply.keys(), default="en"
-                )
-                reply_body = config.work_reply.get(lang, config.work_reply["en"])
-                fwd_note = config.work_forward_note.get(
-                    lang, config.work_forward_note["en"]
-                ).format(sender=thesender)
+                lang = detect_language(themail, reply_langs, default="en")
+                reply_template, note_template = templates.get(lang, default_templates)
+                fwd_note = note_template.format(sender=thesender)
 
                 print(f"WorkEmail ({lang}):", thesender)
 
-                reply_msg = email_utils.build_message(
+                reply_msg = stamp_reply(
+                    reply_template,
                     subject=subject,
-                    from_addr=config.work_reply_from,
                     to_addr=thesender,
-                    body=reply_body,
                     subject_prefix="Re:",
                     in_reply_to=themid,
-                    reply_to=config.work_forward_to,
                     message_id_domain="away",
                 )
 
-                forward_msg = email_utils.build_message(
+                forward_msg = build_message(
                     subject=subject,
                     from_addr=config.work_forward_by,
                     to_addr=config.work_forward_to,
@@ -162,7 +234,7 @@ def WorkEmail(config, send_fn=None):
                 # Forward first (internal, more reliable)
                 try:
                     send_fn(
-                        options,
+                        smtp_options,
                         config.work_forward_by,
                         config.work_forward_to,
                         forward_msg,
@@ -172,7 +244,7 @@ def WorkEmail(config, send_fn=None):
 
                 # Reply second (external, best-effort)
                 try:
-                    send_fn(options, config.work_reply_from, thesender, reply_msg)
+                    send_fn(smtp_options, config.work_reply_from, thesender, reply_msg)
                 except smtplib.SMTPException as e:
                     print(f"Reply failed to {thesender}: {e}")
 
@@ -195,58 +267,63 @@ def Obnoxious(config, send_fn=None):
                  Defaults to email_utils.send_via_smtp
     """
     send_fn = send_fn or email_utils.send_via_smtp
+    should_process = email_utils.should_process_message
+    detect_language = email_utils.detect_language
+    stamp_reply = email_utils.stamp_reply
+    parse_headers = email_utils.parse_headers
+    templates = {
+        lang: email_utils.build_reply_template(
+            from_addr=config.obnoxious_reply_from, body=reply
+        )
+        for lang, reply in config.obnoxious_reply.items()
+    }
+    reply_langs = tuple(templates)
+    default_template = templates["en"]
     delete_handler = Delete()
     expunge_handler = Expunge()
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
-        res, data = server.uid("FETCH", theuids, "RFC822")
+        res, data = fetch_unseen(server, listofuids, options, seen_ids)
 
         delete_handler(server, listofuids, options, seen_ids)
         expunge_handler(server, listofuids, options, seen_ids)
 
-        for ret in data:
-            if isinstance(ret, (list, tuple)):
-                try:
-                    message = ret[1]
-                except IndexError:
-                    continue
-
-                themail = email.message_from_string(message.decode("utf-8"))
+        with email_utils.smtp_session(options) as smtp_options:
+            for message in imap_utils.iter_rfc822(data):
+                # Only headers are needed for the reply
+                themail = parse_headers(message)
                 if not themail:
                     continue
 
-                should_process, seen_ids = email_utils.should_process_message(
-                    themail["Message-ID"], seen_ids
-                )
-                if not should_process:
+                get = themail.get
+                themid = get("Message-ID")
+                if not should_process(themid, seen_ids):
                     continue
 
-                themid = themail["Message-ID"]
-                thesender = themail["Reply-To"] or themail["From"] or themail["Sender"]
-                subject = themail["Subject"]
+                thesender = get("Reply-To") or get("From") or get("Sender")
+                subject = get("Subject")
 
-                lang = email_utils.detect_language(
-                    themail, config.obnoxious_reply.keys(), default="en"
-                )
-                reply_body = config.obnoxious_reply.get(
-                    lang, config.obnoxious_reply["en"]
-                )
+                lang = detect_language(themail, reply_langs, default="en")
+                reply_template = templates.get(lang, default_template)
 
                 print(f"Obnoxious ({lang}):", thesender)
 
-                reply_msg = email_utils.build_message(
+                reply_msg = stamp_reply(
+                    reply_template,
                     subject=subject,
-                    from_addr=config.obnoxious_reply_from,
                     to_addr=thesender,
-                    body=reply_body,
                     subject_prefix="Re:",
                     in_reply_to=themid,
                     message_id_domain="noteventrashcan",
                 )
 
                 try:
-                    send_fn(options, config.obnoxious_reply_from, thesender, reply_msg)
+                    send_fn(
+                        smtp_options,
+                        config.obnoxious_reply_from,
+                        thesender,
+                        reply_msg,
+                    )
                 except smtplib.SMTPException as e:
                     print(f"Obnoxious reply failed to {thesender}: {e}")
 
@@ -267,13 +344,13 @@ def Proxy(config, send_fn=None):
     send_fn = send_fn or email_utils.send_via_smtp
 
     def handler(server, listofuids, options, seen_ids):
-        theuids = b",".join(listofuids)
-        res, data = server.uid("FETCH", theuids, "RFC822")
+        res, data = fetch_unseen(server, listofuids, options, seen_ids)
 
-        for ret in data:
-            seen_ids = proxy_utils.proxy_process_email(
-                ret, server, options, seen_ids, config, send_fn
-            )
+        with email_utils.smtp_session(options) as smtp_options:
+            for message in imap_utils.iter_rfc822(data):
+                seen_ids = proxy_utils.proxy_process_email(
+                    message, server, smtp_options, seen_ids, config, send_fn
+                )
 
         return (res, data, seen_ids)
 
@@ -285,9 +362,14 @@ def runQueries(connection, queries, runtime_options=None):
     Execute query loop with IDLE.
     Processes queries whenever mailbox changes.
 
+    After a cycle in which every search and handler chain succeeded, each
+    query only searches UIDs above the newest one it has already covered.
+    A failed chain leaves the ranges alone so its messages are retried.
+
     Args:
         connection: IMAP connection
-        queries: List of (query_string, handlers) tuples
+        queries: (charset, criteria_bytes, handlers) triples from
+            query_dsl.compile_queries
         runtime_options: Dict with smtp_server, smtp_user, smtp_pass
     """
     runtime_options = runtime_options or {}
@@ -295,32 +377,43 @@ def runQueries(connection, queries, runtime_options=None):
     result = "OK"
     response = True
 
-    processed_message_ids = set()
-    previous_message_ids = set()
+    seen_ids = email_utils.SeenIds()
+    search = connection.uid
+
+    # First UID each query still has to look at
+    floors = [1] * len(queries)
 
     while result == "OK":
         if response:
             print(time.strftime("%Y.%m.%d %H.%M.%S"), response)
 
-            previous_message_ids = processed_message_ids
-            processed_message_ids = set()
-
-            for query_def in queries:
-                query, handler_funcs = query_def
+            newest_uid = 0
+            next_floors = []
+            complete = True
 
-                result, data = connection.uid("SEARCH", None, query)
+            for floor, (charset, query, handler_funcs) in zip(floors, queries):
+                result, data = search(
+                    "SEARCH", charset, b"UID %d:* %b" % (floor, query)
+                )
 
                 if result == "OK":
-                    listofuids = data[0].split()
+                    # "n:*" also matches the highest UID when n exceeds it
+                    listofuids = [uid for uid in data[0].split() if int(uid) >= floor]
                     if len(listofuids) > 0:
-                        seen_ids = processed_message_ids | previous_message_ids
+                        newest_uid = max(newest_uid, *map(int, listofuids))
+                        options = {**runtime_options, "uid_set": b",".join(listofuids)}
 
                         for handlef in handler_funcs:
                             if result == "OK":
                                 result, data, seen_ids = handlef(
-                                    connection, listofuids, runtime_options, seen_ids
+                                    connection, listofuids, options, seen_ids
                                 )
 
-                        processed_message_ids = seen_ids - previous_message_ids
+                complete = complete and result == "OK"
+                # Every UID up to newest_uid existed when this query ran
+                next_floors.append(max(floor, newest_uid + 1))
+
+            if complete:
+                floors = next_floors
 
         (result, response) = imap_utils.idle(connection)
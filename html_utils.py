@@ -4,18 +4,38 @@ HTML transformation: sanitization, deobfuscation, image inlining, text conversio
 """
 
 import base64
+import collections
+import concurrent.futures
+import hashlib
+import re
 import string
+import threading
+import urllib.parse
 
 import html2text
+import lxml.etree
 import lxml.html
 import lxml.html.clean
 
 import http_utils
 
-# Spiegel.de deobfuscation table
-ourAlphabet = string.ascii_letters + string.digits + string.punctuation + "äöüÄÖÜß"
+# Spiegel.de deobfuscation tables
+# ASCII is shifted on UTF-8 bytes (256-entry table); multi-byte sequences
+# never contain ASCII bytes, so the few umlauts are fixed up separately
+ourAlphabet = string.ascii_letters + string.digits + string.punctuation
 ourShiftedAlphabet = "".join([chr(ord(x) + 1) for x in ourAlphabet])
-ourTable = str.maketrans(ourShiftedAlphabet, ourAlphabet)
+ourTable = bytes.maketrans(ourShiftedAlphabet.encode(), ourAlphabet.encode())
+ourUmlauts = [(chr(ord(x) + 1), x) for x in "äöüÄÖÜß"]
+
+# Every text and tail inside an "obfuscated" element, except link/br text
+ourObfuscatedText = lxml.etree.XPath(
+    "descendant-or-self::*[contains(concat(' ', normalize-space(@class), ' '),"
+    " ' obfuscated ')]/descendant::text()"
+    "[not((parent::a or parent::br) and not(preceding-sibling::node()))]"
+)
+
+# Returns a list, so images can be dropped while walking the result
+ourImages = lxml.etree.XPath("//img")
 
 
 # HTML cleaner configuration
@@ -36,79 +56,87 @@ ourCleaner = lxml.html.clean.Cleaner(
     remove_tags=["span"],
     remove_unknown_tags=True,
     safe_attrs_only=True,
-    safe_attrs=[
-        "abbr",
-        "accesskey",
-        "alt",
-        "border",
-        "charset",
-        "checked",
-        "cite",
-        "clear",
-        "cols",
-        "colspan",
-        "datetime",
-        "descr",
-        "dir",
-        "disabled",
-        "download",
-        "height",
-        "href",
-        "hreflang",
-        "id",
-        "label",
-        "lang",
-        "longdesc",
-        "maxlength",
-        "media",
-        "name",
-        "nohref",
-        "rows",
-        "rowspan",
-        "selected",
-        "src",
-        "summary",
-        "tabindex",
-        "title",
-        "type",
-        "usemap",
-        "value",
-        "width",
-        "xml:lang",
-    ],
+    safe_attrs=frozenset(
+        [
+            "abbr",
+            "accesskey",
+            "alt",
+            "border",
+            "charset",
+            "checked",
+            "cite",
+            "clear",
+            "cols",
+            "colspan",
+            "datetime",
+            "descr",
+            "dir",
+            "disabled",
+            "download",
+            "height",
+            "href",
+            "hreflang",
+            "id",
+            "label",
+            "lang",
+            "longdesc",
+            "maxlength",
+            "media",
+            "name",
+            "nohref",
+            "rows",
+            "rowspan",
+            "selected",
+            "src",
+            "summary",
+            "tabindex",
+            "title",
+            "type",
+            "usemap",
+            "value",
+            "width",
+            "xml:lang",
+        ]
+    ),
     add_nofollow=False,
 )
 
 
+def _unshift(text):
+    """Shift Spiegel-obfuscated characters back by one code point"""
+    text = text.encode("utf-8").translate(ourTable).decode("utf-8")
+    if not text.isascii():
+        for shifted, plain in ourUmlauts:
+            if shifted in text:
+                text = text.replace(shifted, plain)
+    return text
+
+
 def deobfuscate_spiegel(tree):
     """
     Spiegel.de uses character shifting to prevent scraping.
     This reverses their obfuscation by shifting characters back.
     """
-    for parent in tree.find_class("obfuscated"):
-        for child in parent:
-            for grandchild in child:
-                for orphan in grandchild:
-                    if orphan.tail:
-                        orphan.tail = orphan.tail.translate(ourTable)
-                if grandchild.text and not (grandchild.tag in ("a", "br")):
-                    grandchild.text = grandchild.text.translate(ourTable)
-                if grandchild.tail:
-                    grandchild.tail = grandchild.tail.translate(ourTable)
-            if child.text and not (child.tag in ("a", "br")):
-                child.text = child.text.translate(ourTable)
-            if child.tail:
-                child.tail = child.tail.translate(ourTable)
-        if parent.text:
-            parent.text = parent.text.translate(ourTable)
+    for text in ourObfuscatedText(tree):
+        element = text.getparent()
+        if text.is_tail:
+            element.tail = _unshift(text)
+        else:
+            element.text = _unshift(text)
 
     return tree
 
 
 def apply_deobfuscation(tree, url, deobfuscators):
-    """Apply registered deobfuscators based on URL"""
-    for domain, func_name in deobfuscators.items():
-        if domain in url:
+    """
+    Apply registered deobfuscators based on the URL's host.
+    A rule for "spiegel.de" also covers "www.spiegel.de"; each suffix of the
+    host is one dict lookup, however many rules are registered.
+    """
+    labels = (urllib.parse.urlsplit(url).hostname or "").split(".")
+    for i in range(len(labels)):
+        func_name = deobfuscators.get(".".join(labels[i:]))
+        if func_name:
             deobfuscator = globals().get(func_name)
             if deobfuscator and callable(deobfuscator):
                 tree = deobfuscator(tree)
@@ -116,90 +144,123 @@ def apply_deobfuscation(tree, url, deobfuscators):
 
 
 def bleach_content(tree, base_href, deobfuscators=None):
-    """Remove dangerous HTML elements and apply site-specific deobfuscation"""
+    """
+    Remove dangerous HTML elements and apply site-specific deobfuscation.
+    The tree is cleaned in place (clean_html would first deep-copy it).
+    """
     if deobfuscators:
         tree = apply_deobfuscation(tree, base_href, deobfuscators)
 
-    tree = ourCleaner.clean_html(tree)
+    ourCleaner(tree)
     return tree
 
 
-def include_images_in_tree(tree, timeout=10, max_images=100):
+def _fetch_image_data(src, timeout):
+    """
+    Fetch image as a base64 data URI, using the disk cache.
+
+    Returns:
+        Data URI bytes, or b"" if the image could not be fetched
+    """
+    cached = http_utils.get_cached(src)
+    if cached:
+        return cached
+
+    try:
+        content, base_href, headers, info = http_utils.fetch_url(src, timeout=timeout)
+        content_base64 = base64.b64encode(content)
+        mimetype = headers.get("content-type", "application/octet-stream").encode(
+            "ascii"
+        )
+        all_data = b"".join((b"data:", mimetype, b";base64,", content_base64))
+
+        # Workers may store the same key at once (two sources redirecting
+        # to one target); store_cached renames atomically, so that is safe
+        http_utils.store_cached(src, all_data)
+        if base_href != src:
+            # Also cache under the redirect target other pages may link to
+            http_utils.store_cached(base_href, all_data)
+        return all_data
+    except Exception:
+        return b""
+
+
+# Leading integer of an HTML width/height attribute ("120", "120px", "120.5")
+_LEADING_INT = re.compile(r"\s*(\d+)")
+
+
+def _parse_dimension(dim_str):
+    """Pixel size from an img width/height attribute; 100 if relative or unknown"""
+    if "%" in dim_str or "auto" in dim_str:
+        return 100
+    match = _LEADING_INT.match(dim_str)
+    return int(match.group(1)) if match else 100
+
+
+def include_images_in_tree(tree, timeout=10, max_images=100, workers=8):
     """
     Fetch and inline images as base64 data URIs.
+    Images are fetched concurrently; the tree is only modified afterwards.
 
     Args:
         tree: lxml HTML tree
         timeout: Per-image fetch timeout in seconds
-        max_images: Maximum number of images to process
+        max_images: Maximum number of images to fetch
+        workers: Number of concurrent image fetches
 
     Returns:
         Modified tree with inlined images
     """
-    images = tree.xpath("//img")
-    images_processed = 0
-
-    for img in images:
-        if images_processed >= max_images:
-            img.drop_tag()
-            continue
+    wanted = []
 
+    for img in ourImages(tree):
         src = img.get("src")
-        awidth = img.get("width", "0")
-        aheight = img.get("height", "0")
-
-        def parse_dimension(dim_str):
-            if "%" in dim_str or "auto" in dim_str or len(dim_str) < 1:
-                return 100
-            if "px" in dim_str:
-                return int(dim_str[: dim_str.index("px")])
-            if "." in dim_str:
-                return int(dim_str[: dim_str.index(".")])
-            return int(dim_str) if dim_str.isdigit() else 100
-
-        width = parse_dimension(awidth)
-        height = parse_dimension(aheight)
+        width = _parse_dimension(img.get("width", "0"))
+        height = _parse_dimension(img.get("height", "0"))
         area = width * height
 
-        if ((area < 1) or (area >= (100 * 100))) and src:
-            print(f"IMG: {src}")
-
-            cached = http_utils.get_cached(src)
-            if cached:
-                all_data = cached
-            else:
-                try:
-                    content, base_href, headers, info = http_utils.fetch_url(
-                        src, timeout=timeout
-                    )
-                    content_base64 = base64.b64encode(content)
-                    mimetype = headers.get(
-                        "content-type", "application/octet-stream"
-                    ).encode("ascii")
-                    all_data = b"data:" + mimetype + b";base64," + content_base64
-
-                    http_utils.store_cached(src, all_data)
-                    http_utils.store_cached(base_href, all_data)
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except Exception:
-                    all_data = b""
-
-            if all_data:
-                img.set("src", all_data.decode("ascii"))
-                img.set("width", "100%")
-                img.set("height", "auto")
-                images_processed += 1
-            else:
-                img.drop_tag()
+        if ((area < 1) or (area >= (100 * 100))) and src and len(wanted) < max_images:
+            wanted.append((img, src))
+        else:
+            img.drop_tag()
+
+    if not wanted:
+        return tree
+
+    # Filtering is done; fetch each distinct source once, all at the same time
+    sources = list(dict.fromkeys(src for _, src in wanted))
+    for src in sources:
+        print(f"IMG: {src}")
+
+    workers = min(workers, len(sources))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(
+            zip(
+                sources,
+                executor.map(lambda src: _fetch_image_data(src, timeout), sources),
+            )
+        )
+
+    for img, src in wanted:
+        all_data = results[src]
+        if all_data:
+            img.set("src", all_data.decode("ascii"))
+            img.set("width", "100%")
+            img.set("height", "auto")
         else:
             img.drop_tag()
 
     return tree
 
 
-def make_html2text_converter():
-    """Create configured html2text parser for converting HTML to plain text."""
+def make_html2text_converter(ignore_links=False):
+    """
+    Create configured html2text parser for converting HTML to plain text.
+
+    HTML2Text keeps parser state (link and list stacks) between handle()
+    calls, so converters are cheap to build but must not be shared
+    across threads or documents.
+    """
     converter = html2text.HTML2Text()
     converter.body_width = 0
     converter.single_line_break = False
@@ -217,7 +278,7 @@ def make_html2text_converter():
     converter.ignore_tables = False
     converter.bypass_tables = False
     converter.pad_tables = False
-    converter.ignore_links = False
+    converter.ignore_links = ignore_links
     converter.skip_internal_links = True
     converter.use_automatic_links = False
     converter.inline_links = True
@@ -228,11 +289,59 @@ def make_html2text_converter():
     return converter
 
 
+# Recent transform results, keyed by a hash of the incoming document and
+# the flags; config is fixed for the lifetime of the process. Bounded by
+# entries and by total content size; large documents are never memoized
+_TRANSFORM_CACHE_ENTRIES = 256
+_TRANSFORM_CACHE_BYTES = 16 * 1024 * 1024
+_TRANSFORM_CACHE_MAX_ENTRY = 1024 * 1024
+_transform_cache = collections.OrderedDict()
+_transform_cache_bytes = 0
+_transform_lock = threading.Lock()
+
+
+def clear_transform_cache():
+    """Drop all memoized transform_html_content results"""
+    global _transform_cache_bytes
+
+    with _transform_lock:
+        _transform_cache.clear()
+        _transform_cache_bytes = 0
+
+
+def _remember_transform(key, result):
+    """Memoize a transform result, evicting least recently used by count and size"""
+    global _transform_cache_bytes
+
+    size = len(result[0])
+    if size > _TRANSFORM_CACHE_MAX_ENTRY:
+        return
+
+    with _transform_lock:
+        previous = _transform_cache.pop(key, None)
+        if previous is not None:
+            _transform_cache_bytes -= len(previous[0])
+
+        _transform_cache[key] = result
+        _transform_cache_bytes += size
+
+        while (
+            len(_transform_cache) > _TRANSFORM_CACHE_ENTRIES
+            or _transform_cache_bytes > _TRANSFORM_CACHE_BYTES
+        ):
+            _, evicted = _transform_cache.popitem(last=False)
+            _transform_cache_bytes -= len(evicted[0])
+
+
 def transform_html_content(
     tree, base_href, config, bleach_html, include_images, as_txt, txt_without_links
 ):
     """
     Apply HTML transformations: bleaching, image inlining, text conversion.
+    Results for a document already transformed with the same flags are
+    reused; with include_images the work is always redone, since image
+    fetches may have failed transiently, and documents over
+    _TRANSFORM_CACHE_MAX_ENTRY are not memoized.
 
     Args:
         tree: lxml HTML tree (already with absolute links)
@@ -246,6 +355,24 @@ def transform_html_content(
     Returns:
         (content, title, subtype, prefix) tuple
     """
+    key = None
+    source = None
+    if not include_images:
+        source = lxml.html.tostring(tree)
+    if source is not None and len(source) <= _TRANSFORM_CACHE_MAX_ENTRY:
+        key = (
+            hashlib.blake2b(source, digest_size=16).digest(),
+            base_href,
+            bleach_html,
+            as_txt,
+            txt_without_links,
+        )
+        with _transform_lock:
+            cached = _transform_cache.get(key)
+            if cached is not None:
+                _transform_cache.move_to_end(key)
+                return cached
+
     prefix = ""
 
     if bleach_html:
@@ -260,15 +387,21 @@ def transform_html_content(
             max_images=config.default_max_images,
         )
 
-    content = lxml.html.tostring(tree).decode("utf-8")
+    # Serialize once, as ASCII with character references: html2text folds
+    # those to plain ASCII (’ -> '), and the result must survive being
+    # re-encoded in the page's declared charset
+    # An unbleached tree without images is unchanged since the cache key
+    # was built, so its serialization can be reused
+    if source is None or bleach_html:
+        source = lxml.html.tostring(tree)
+    content = source.decode("ascii")
 
     if as_txt:
-        converter = make_html2text_converter()
         if txt_without_links:
-            converter.ignore_links = True
             prefix = "TP" + prefix
         else:
             prefix = "TL" + prefix
+        converter = make_html2text_converter(ignore_links=txt_without_links)
         content = converter.handle(content)
         subtype = "plain"
     else:
@@ -279,4 +412,7 @@ def transform_html_content(
     except AttributeError:
         title = None
 
-    return content, title, subtype, prefix
+    result = (content, title, subtype, prefix)
+    if key is not None:
+        _remember_transform(key, result)
+    return result
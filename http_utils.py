@@ -3,27 +3,267 @@
 HTTP fetching and disk caching utilities.
 """
 
+import atexit
+import collections
+import functools
 import gzip
 import hashlib
+import http.client
 import os
+import re
 import struct
+import tempfile
+import threading
+import time
 import urllib.error
+import urllib.parse
 import urllib.request
 import zlib
 from io import BytesIO
 
 import config_data
 
+HTTP_HEADERS = {
+    "Cache-Control": "no-transform",
+    "User-Agent": config_data.http_user_agent,
+}
+
+# Fallback for non-HTTP schemes (e.g. data: URIs in img src)
 URLOpener = urllib.request.build_opener()
-URLOpener.addheaders = [
-    ("Cache-Control", "no-transform"),
-    ("User-Agent", config_data.http_user_agent),
-]
+URLOpener.addheaders = list(HTTP_HEADERS.items())
+
+# Keep-alive connection pool: (scheme, netloc) -> [(connection, idle_since)],
+# least recently used host first
+_MAX_IDLE_PER_HOST = 4
+_MAX_IDLE_TOTAL = 32
+_IDLE_TIMEOUT = 30  # seconds; servers drop idle keep-alives, leaving CLOSE_WAIT
+_MAX_REDIRECTS = 10
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+_MAX_REDIRECT_BODY = 64 * 1024
+_READ_CHUNK = 64 * 1024
+_idle_connections = collections.OrderedDict()
+_pool_lock = threading.Lock()
+
+
+def _pool_key(url):
+    parts = urllib.parse.urlsplit(url)
+    return (parts.scheme.lower(), parts.netloc)
+
+
+def _proxied(url):
+    """True if the *_proxy environment routes url through a proxy"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme.lower() not in urllib.request.getproxies():
+        return False
+    return not urllib.request.proxy_bypass(parts.hostname or "")
+
+
+def _expire_idle(now):
+    """Remove connections idle longer than _IDLE_TIMEOUT. Caller holds the lock"""
+    expired = []
+    for key in list(_idle_connections):
+        idle = _idle_connections[key]
+        fresh = [entry for entry in idle if now - entry[1] < _IDLE_TIMEOUT]
+        expired.extend(c for c, since in idle if now - since >= _IDLE_TIMEOUT)
+        if fresh:
+            _idle_connections[key] = fresh
+        else:
+            del _idle_connections[key]
+    return expired
+
+
+def _checkout(key, timeout):
+    """Take an idle connection for key, or create one. Returns (conn, reused)"""
+    with _pool_lock:
+        expired = _expire_idle(time.monotonic())
+        idle = _idle_connections.get(key)
+        connection = idle.pop()[0] if idle else None
+        if idle == []:
+            del _idle_connections[key]
+
+    for stale in expired:
+        stale.close()
+
+    if connection is None:
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    connection.timeout = timeout
+    if connection.sock:
+        connection.sock.settimeout(timeout)
+    return connection, True
+
+
+def _checkin(key, connection):
+    """
+    Return connection to the pool, or close it if its host's pool is full.
+    Past _MAX_IDLE_TOTAL, the oldest connections of the least recently
+    used hosts are closed.
+    """
+    now = time.monotonic()
+    with _pool_lock:
+        closing = _expire_idle(now)
+        idle = _idle_connections.setdefault(key, [])
+        _idle_connections.move_to_end(key)
+        if len(idle) < _MAX_IDLE_PER_HOST:
+            idle.append((connection, now))
+        else:
+            closing.append(connection)
+
+        total = sum(len(conns) for conns in _idle_connections.values())
+        while total > _MAX_IDLE_TOTAL:
+            lru_key, lru_idle = next(iter(_idle_connections.items()))
+            closing.append(lru_idle.pop(0)[0])
+            if not lru_idle:
+                del _idle_connections[lru_key]
+            total -= 1
+
+    for stale in closing:
+        stale.close()
+
+
+def close_idle_connections():
+    """Close every pooled keep-alive connection"""
+    with _pool_lock:
+        idle = [c for conns in _idle_connections.values() for c, _ in conns]
+        _idle_connections.clear()
+    for connection in idle:
+        connection.close()
+
+
+atexit.register(close_idle_connections)
+
+
+def _request(url, timeout):
+    """
+    GET url on a pooled connection.
+    A reused connection the server has meanwhile closed is retried once
+    on a fresh connection.
+    """
+    key = _pool_key(url)
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+    while True:
+        connection, reused = _checkout(key, timeout)
+        try:
+            connection.request("GET", path, headers=HTTP_HEADERS)
+            return connection, connection.getresponse()
+        except ConnectionError as e:
+            connection.close()
+            if not reused:
+                raise urllib.error.URLError(e) from e
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            raise urllib.error.URLError(e) from e
+
+
+def _open_urllib(url, timeout):
+    """Open url through urllib (proxies, non-http schemes)"""
+    httpcon = URLOpener.open(url, timeout=timeout)
+    return httpcon.geturl(), httpcon, None
+
+
+def _open(url, timeout):
+    """
+    Open url, following redirects.
+    http(s) goes through the keep-alive pool; URLs the *_proxy environment
+    sends through a proxy go through urllib. Other schemes are only
+    accepted for the caller's own URL, never as a redirect target.
+
+    Returns:
+        (final_url, response, connection) - connection is None for urllib
+
+    Raises:
+        urllib.error.HTTPError: On error status, a redirect without
+            Location or a redirect to a non-http(s) URL
+    """
+    if _pool_key(url)[0] not in ("http", "https"):
+        return _open_urllib(url, timeout)
+
+    for _ in range(_MAX_REDIRECTS + 1):
+        if _proxied(url):
+            return _open_urllib(url, timeout)
+
+        connection, response = _request(url, timeout)
+        location = response.getheader("Location")
+
+        if response.status in _REDIRECT_CODES and location:
+            target = urllib.parse.urljoin(url, location)
+            if _pool_key(target)[0] not in ("http", "https"):
+                connection.close()
+                raise urllib.error.HTTPError(
+                    target,
+                    response.status,
+                    f"{response.reason} - Redirection to url '{target}' "
+                    "is not allowed",
+                    response.msg,
+                    None,
+                )
+            # Drain a small body to keep the connection; drop a large one
+            try:
+                _read_capped(response, _MAX_REDIRECT_BODY)
+            except (ValueError, http.client.HTTPException, OSError):
+                connection.close()
+            else:
+                _finish(url, response, connection)
+            url = target
+            continue
+
+        if response.status >= 300:
+            connection.close()
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.msg, None
+            )
+
+        return url, response, connection
+
+    raise urllib.error.URLError(f"Too many redirects for {url}")
+
+
+def _finish(url, response, connection):
+    """Pool a fully read keep-alive connection, close anything else"""
+    if connection is None:
+        response.close()
+    elif response.isclosed() and not response.will_close:
+        _checkin(_pool_key(url), connection)
+    else:
+        connection.close()
+
+
+def _read_capped(httpcon, max_size):
+    """
+    Read a response body in chunks, aborting once it exceeds max_size.
+
+    Raises:
+        ValueError: If content exceeds max_size
+        http.client.IncompleteRead: If the body ends before Content-Length
+    """
+    length = httpcon.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > max_size:
+        raise ValueError(f"Content exceeds max size of {max_size} bytes")
+
+    content = bytearray()
+    while True:
+        chunk = httpcon.read(_READ_CHUNK)
+        if not chunk:
+            # A read with a size returns short instead of raising on EOF
+            if length.isdigit() and len(content) < int(length):
+                raise http.client.IncompleteRead(
+                    bytes(content), int(length) - len(content)
+                )
+            return bytes(content)
+        content += chunk
+        if len(content) > max_size:
+            raise ValueError(f"Content exceeds max size of {max_size} bytes")
 
 
 def fetch_url(url, timeout=30, max_size=100 * 1024 * 1024):
     """
     Fetch URL with timeout and size limit.
+    HTTP(S) connections are kept alive and reused per host.
 
     Args:
         url: URL to fetch
@@ -38,16 +278,18 @@ def fetch_url(url, timeout=30, max_size=100 * 1024 * 1024):
         ValueError: If content exceeds max_size
     """
     try:
-        httpcon = URLOpener.open(url, timeout=timeout)
-
-        content = httpcon.read(max_size)
+        base_href, httpcon, connection = _open(url, timeout)
 
-        extra = httpcon.read(1)
-        if extra:
-            httpcon.close()
-            raise ValueError(f"Content exceeds max size of {max_size} bytes")
+        try:
+            content = _read_capped(httpcon, max_size)
+        except (http.client.HTTPException, OSError) as e:
+            (connection or httpcon).close()
+            raise urllib.error.URLError(e) from e
+        except BaseException:
+            (connection or httpcon).close()
+            raise
 
-        httpcon.close()
+        _finish(base_href, httpcon, connection)
 
     except urllib.error.URLError as e:
         print(f"Failed to fetch {url}")
@@ -57,9 +299,8 @@ def fetch_url(url, timeout=30, max_size=100 * 1024 * 1024):
             print("Error code:", e.code)
         raise
 
-    base_href = httpcon.geturl()
     headers = dict((k.lower(), v) for k, v in httpcon.headers.items())
-    info = httpcon.info()
+    info = httpcon.headers
 
     if content and "gzip" in headers.get("content-encoding", ""):
         try:
@@ -99,9 +340,16 @@ def fetch_and_decode_url(url, timeout=30, max_size=100 * 1024 * 1024):
     return (content, base_href, headers, info, mimetype, subtype)
 
 
+# filename="x", filename='x', filename=x and RFC 2231 filename*=UTF-8''x
+_FILENAME_PARAM = re.compile(
+    r"""filename(\*?)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^;\s]*))""", re.IGNORECASE
+)
+
+
 def get_filename_from_headers_or_url(headers, url):
     """
     Extract filename from Content-Disposition header or URL.
+    An RFC 2231 filename* parameter wins over a plain filename.
 
     Args:
         headers: Dict of HTTP headers
@@ -110,13 +358,25 @@ def get_filename_from_headers_or_url(headers, url):
     Returns:
         Filename string
     """
-    if "content-disposition" in headers:
-        cd = headers["content-disposition"]
-        if "filename=" in cd:
-            start = cd.index("filename=") + 9
-            end = cd.find(";", start)
-            filename = cd[start:end] if end > 0 else cd[start:]
-            return filename.strip("\"'")
+    filename = None
+    for match in _FILENAME_PARAM.finditer(headers.get("content-disposition", "")):
+        starred, double, single, bare = match.groups()
+        value = double if double is not None else single if single is not None else bare
+        if starred:
+            # charset'language'percent-encoded-name
+            parts = value.split("'", 2)
+            if len(parts) == 3 and parts[2]:
+                charset, _, encoded = parts
+                try:
+                    return urllib.parse.unquote(
+                        encoded, encoding=charset or "utf-8", errors="replace"
+                    )
+                except LookupError:
+                    return urllib.parse.unquote(encoded, errors="replace")
+        elif filename is None:
+            filename = value
+    if filename:
+        return filename
 
     name = (
         url.replace("http://", "")
@@ -127,9 +387,70 @@ def get_filename_from_headers_or_url(headers, url):
     return os.path.basename(name) if name else "download"
 
 
+# In-memory LRU in front of the disk cache, bounded by count and bytes
+_MEMORY_CACHE_ENTRIES = 256
+_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+_memory_cache = collections.OrderedDict()
+_memory_cache_bytes = 0
+_memory_lock = threading.Lock()
+
+
+def _recall(url):
+    """Get content from the memory cache, marking it recently used"""
+    with _memory_lock:
+        content = _memory_cache.get(url)
+        if content is not None:
+            _memory_cache.move_to_end(url)
+        return content
+
+
+def _remember(url, content):
+    """Put content in the memory cache, evicting least recently used"""
+    global _memory_cache_bytes
+
+    with _memory_lock:
+        previous = _memory_cache.pop(url, None)
+        if previous is not None:
+            _memory_cache_bytes -= len(previous)
+
+        if len(content) > _MEMORY_CACHE_BYTES:
+            return
+
+        _memory_cache[url] = content
+        _memory_cache_bytes += len(content)
+
+        while (
+            len(_memory_cache) > _MEMORY_CACHE_ENTRIES
+            or _memory_cache_bytes > _MEMORY_CACHE_BYTES
+        ):
+            _, evicted = _memory_cache.popitem(last=False)
+            _memory_cache_bytes -= len(evicted)
+
+
+def clear_memory_cache():
+    """Drop all in-memory cache entries (the disk cache is untouched)"""
+    global _memory_cache_bytes
+
+    with _memory_lock:
+        _memory_cache.clear()
+        _memory_cache_bytes = 0
+
+
+@functools.lru_cache(maxsize=4096)
+def _cache_key(url):
+    """Cache file name for URL (memoized: looked up by get and store)"""
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _legacy_cache_key(url):
+    """Cache file name used before keys switched from SHA-256 to BLAKE2b"""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
 def get_cached(url):
     """
     Get content from cache if available.
+    Checks the in-memory cache before the disk cache.
 
     Args:
         url: URL to check
@@ -137,30 +458,52 @@ def get_cached(url):
     Returns:
         Cached content or None if not cached
     """
-    cache_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
-    cache_path = os.path.join(config_data.cache_prefix, cache_key)
+    content = _recall(url)
+    if content is not None:
+        return content
 
-    if os.path.isfile(cache_path):
+    cache_path = os.path.join(config_data.cache_prefix, _cache_key(url))
+
+    try:
+        with open(cache_path, "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        # Migrate an entry written under the old key on first hit
+        legacy_path = os.path.join(config_data.cache_prefix, _legacy_cache_key(url))
+        try:
+            os.replace(legacy_path, cache_path)
+        except FileNotFoundError:
+            return None
         with open(cache_path, "rb") as f:
-            return f.read()
+            content = f.read()
 
-    return None
+    _remember(url, content)
+    return content
 
 
 def store_cached(url, content):
     """
-    Store content in cache.
+    Store content in disk and memory cache. The file is written to a
+    temporary name in the cache directory and renamed into place, so
+    concurrent readers never see a partial entry.
 
     Args:
         url: URL key
         content: Content to cache
     """
     os.makedirs(config_data.cache_prefix, exist_ok=True)
-    cache_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
-    cache_path = os.path.join(config_data.cache_prefix, cache_key)
+    cache_path = os.path.join(config_data.cache_prefix, _cache_key(url))
+
+    fd, tmp_path = tempfile.mkstemp(dir=config_data.cache_prefix, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-    with open(cache_path, "wb") as f:
-        f.write(content)
+    _remember(url, content)
 
 
 def get_or_fetch(url, timeout=30):
@@ -3,21 +3,30 @@
 IMAP protocol utilities: IDLE implementation, connection helpers, credentials, main run loop.
 """
 
+import email
+import functools
 import getpass
 import imaplib
 import os
-import select
+import re
+import selectors
 import socket
 import sys
 import time
 
+import email_utils
+
 CRLF = b"\r\n"
 imaplib.Commands["IDLE"] = ("AUTH", "SELECTED")
 
+_FETCH_UID = re.compile(rb"\bUID (\d+)")
+
 
+@functools.lru_cache(maxsize=8)
 def get_credential(env_var, arg_name, prompt):
     """
     Get credential from environment, command line args, or prompt.
+    Looked up once per process; later calls return the same value.
 
     Priority:
     1. Environment variable
@@ -37,6 +46,71 @@ def get_credential(env_var, arg_name, prompt):
     return getpass.getpass(prompt)
 
 
+def has_capability(connection, name):
+    """Check whether the server advertised an IMAP capability (e.g. "MOVE")"""
+    return name in connection.capabilities
+
+
+def refresh_capabilities(connection):
+    """
+    Re-read capabilities from the server.
+    imaplib only records the pre-login greeting; many servers (e.g. Dovecot)
+    advertise extensions such as MOVE only once authenticated.
+    Keeps the old snapshot if the CAPABILITY command fails.
+    """
+    typ, data = connection.capability()
+    if typ == "OK" and data and data[-1]:
+        connection.capabilities = tuple(data[-1].decode("ascii").upper().split())
+    return connection.capabilities
+
+
+def iter_rfc822(data):
+    """
+    Yield message bytes from UID FETCH response data.
+    imaplib returns (metadata, payload) tuples interleaved with b")"
+    separators; only the payloads are yielded.
+    """
+    for ret in data:
+        if isinstance(ret, tuple) and len(ret) > 1:
+            yield ret[1]
+
+
+def fetch_headers(connection, uids, fields):
+    """
+    Fetch selected header fields without touching the \\Seen flag.
+
+    Args:
+        connection: IMAP4 connection
+        uids: Comma-joined UID set (bytes)
+        fields: Header names, e.g. ("MESSAGE-ID",)
+
+    Returns:
+        (typ, [(uid, headers), ...]) where headers is a parsed message
+        holding only the requested fields; on failure (typ, data).
+        Servers may place the UID item before or after the literal, so
+        both are checked; uid is None when neither carries one.
+    """
+    query = f"(UID BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})])"
+    typ, data = connection.uid("FETCH", uids, query)
+    if typ != "OK":
+        return typ, data
+
+    headers = []
+    for i, ret in enumerate(data):
+        if isinstance(ret, tuple) and len(ret) > 1:
+            match = _FETCH_UID.search(ret[0])
+            trailer = data[i + 1] if i + 1 < len(data) else None
+            if not match and isinstance(trailer, bytes):
+                match = _FETCH_UID.search(trailer)
+            headers.append(
+                (
+                    match.group(1) if match else None,
+                    email.message_from_bytes(ret[1], policy=email_utils.EMAIL_POLICY),
+                )
+            )
+    return typ, headers
+
+
 def idle(connection, timeout=(29 * 60 - 1)):
     """
     Implements IMAP IDLE extension as described in RFC 2177.
@@ -49,20 +123,43 @@ def idle(connection, timeout=(29 * 60 - 1)):
     Returns:
         (typ, untagged_responses) tuple
     """
-    if "IDLE" not in connection.capabilities:
+    if not has_capability(connection, "IDLE"):
         raise connection.error("server does not support IDLE command.")
 
     connection.untagged_responses = {}
     tag = connection._command("IDLE")
     connection._get_response()
 
-    select.select([connection.socket()], [], [], timeout)
+    with selectors.DefaultSelector() as selector:
+        selector.register(connection.socket(), selectors.EVENT_READ)
+        selector.select(timeout)
 
     connection.send(b"DONE" + CRLF)
     typ, data = connection._command_complete("IDLE", tag)
     return typ, connection.untagged_responses
 
 
+def enable_keepalive(sock, idle=60, interval=30, count=4):
+    """
+    Turn on TCP keepalive so a silently dropped peer is noticed during IDLE.
+
+    Args:
+        sock: Connected socket
+        idle: Seconds of silence before the first probe
+        interval: Seconds between probes
+        count: Unanswered probes before the connection is reset
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Tuning knobs are platform specific (TCP_KEEPIDLE is Linux-only)
+    for name, value in (
+        ("TCP_KEEPIDLE", idle),
+        ("TCP_KEEPINTVL", interval),
+        ("TCP_KEEPCNT", count),
+    ):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
 def connect_and_select(config, password):
     """
     Connect to IMAP server and select inbox.
@@ -78,7 +175,9 @@ def connect_and_select(config, password):
         socket.error, imaplib.IMAP4.abort on connection failures
     """
     connection = imaplib.IMAP4_SSL(config.imap_server)
+    enable_keepalive(connection.socket())
     connection.login(config.imap_user, password)
+    refresh_capabilities(connection)
     connection.select(config.inbox)
     return connection
 
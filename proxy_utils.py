@@ -4,12 +4,14 @@ Proxy handler utilities: URL fetching, option parsing, message building.
 All functions prefixed with proxy_ to indicate scope.
 """
 
-import email.parser
+import concurrent.futures
+import email
 import imaplib
 import re
 import time
 import traceback
 import urllib.error
+import urllib.parse
 
 import lxml.html
 
@@ -17,6 +19,9 @@ import email_utils
 import html_utils
 import http_utils
 
+# Concurrent URL fetches per proxied email
+_PROXY_FETCH_WORKERS = 4
+
 # ============================================================================
 # URL extraction
 # ============================================================================
@@ -32,25 +37,47 @@ import http_utils
 # Current pattern:
 # - Matches http:// or https://
 # - Excludes characters that are never in URLs or are prose delimiters
-# - Strips trailing punctuation that may be captured
-_URL_PATTERN = re.compile(r"https?://[^\s<>\"{}|\\^`\[\]'()]+")
+# - Must end on a character other than .,;:!?* which are valid in URLs but
+#   usually trailing prose punctuation (backtracking drops them at match time)
+_URL_PATTERN = re.compile(
+    r"https?://[^\s<>\"{}|\\^`\[\]'()]*[^\s<>\"{}|\\^`\[\]'().,;:!?*]"
+)
 
-# Valid in URLs but often appear as trailing prose punctuation
-_TRAILING_PUNCTUATION = ".,;:!?*"
+# Same result as replacing \r\n, then \n\r, then \r with \n, in one pass
+_NEWLINES = re.compile(r"\r\n\r?|\n\r|\r")
 
 
 def _proxy_extract_urls_from_text(text):
     """
-    Extract URLs from text, stripping trailing punctuation.
+    Extract URLs from text, excluding trailing punctuation.
 
     Args:
         text: String to scan for URLs
 
     Returns:
-        Set of cleaned URLs
+        Set of URLs
+    """
+    return set(_URL_PATTERN.findall(text))
+
+
+def _proxy_normalize_url(url):
     """
-    found = _URL_PATTERN.findall(text)
-    return {url.rstrip(_TRAILING_PUNCTUATION) for url in found}
+    Canonicalize a URL so variants that fetch the same resource collapse.
+
+    Lowercases scheme and host and drops the fragment, which is never sent
+    to the server. Netlocs with userinfo are left alone.
+
+    Args:
+        url: URL as extracted from text
+
+    Returns:
+        Normalized URL
+    """
+    parts = urllib.parse.urlsplit(url)
+    netloc = parts.netloc if "@" in parts.netloc else parts.netloc.lower()
+    return urllib.parse.urlunsplit(
+        (parts.scheme.lower(), netloc, parts.path, parts.query, "")
+    )
 
 
 def proxy_parse_options(to_addr, config, sender):
@@ -100,7 +127,7 @@ def proxy_decode_text_content(content, charset):
         Decoded string with normalized newlines
     """
     content_str = None
-    for encoding in [charset, "utf-8", "iso-8859-1"]:
+    for encoding in dict.fromkeys((charset, "utf-8", "iso-8859-1")):
         try:
             content_str = content.decode(encoding)
             break
@@ -110,7 +137,7 @@ def proxy_decode_text_content(content, charset):
     if content_str is None:
         content_str = content.decode("utf-8", errors="replace")
 
-    return content_str.replace("\r\n", "\n").replace("\n\r", "\n").replace("\r", "\n")
+    return _NEWLINES.sub("\n", content_str)
 
 
 def proxy_fix_filename_extension(filename, subtype):
@@ -133,7 +160,7 @@ def proxy_fix_filename_extension(filename, subtype):
 
 def proxy_extract_urls(themail, subject):
     """
-    Extract deduplicated URLs from email body and subject.
+    Extract deduplicated, normalized URLs from email body and subject.
 
     Args:
         themail: Parsed email message
@@ -142,14 +169,16 @@ def proxy_extract_urls(themail, subject):
     Returns:
         Set of URLs
     """
-    urls = set()
+    texts = []
 
-    # Extract from email body (all text parts)
-    converter = html_utils.make_html2text_converter()
+    # Collect email body: every text part at any depth, each decoded once;
+    # attachments of other types are never decoded
+    converter = None
 
-    parts = themail.iter_parts() if themail.is_multipart() else [themail]
+    for part in themail.walk():
+        if part.get_content_maintype() != "text":
+            continue
 
-    for part in parts:
         decoded = email_utils.decode_part(part)
         if not decoded:
             continue
@@ -157,17 +186,21 @@ def proxy_extract_urls(themail, subject):
         content_type = part.get_content_type()
 
         if content_type == "text/html":
-            text = converter.handle(decoded)
+            if converter is None:
+                converter = html_utils.make_html2text_converter()
+            texts.append(converter.handle(decoded))
         else:
-            text = decoded
-
-        urls.update(_proxy_extract_urls_from_text(text))
+            texts.append(decoded)
 
-    # Extract from subject
+    # Collect subject
     if subject:
-        urls.update(_proxy_extract_urls_from_text(subject))
+        texts.append(subject)
+
+    # Scan everything in one pass; newlines keep parts from running together
+    found = _proxy_extract_urls_from_text("\n".join(texts))
 
-    return urls
+    # Collapse variants so each resource is fetched once per email
+    return {_proxy_normalize_url(url) for url in found}
 
 
 def proxy_build_message_from_url(url, subject, ref_mid, proxy_options, config):
@@ -203,7 +236,12 @@ def proxy_build_message_from_url(url, subject, ref_mid, proxy_options, config):
 
         if "html" in subtype:
             tree = lxml.html.fromstring(content)
-            tree.make_links_absolute(base_href, resolve_base_href=True)
+            # Links only survive into HTML or linked text; images need them to fetch
+            if (
+                not (proxy_options["as_txt"] and proxy_options["txt_without_links"])
+                or proxy_options["include_images"]
+            ):
+                tree.make_links_absolute(base_href, resolve_base_href=True)
 
             content, html_title, subtype, prefix = html_utils.transform_html_content(
                 tree,
@@ -276,7 +314,15 @@ def proxy_build_message_from_url(url, subject, ref_mid, proxy_options, config):
 
 
 def proxy_fetch_and_store_url(
-    url, subject, ref_mid, proxy_options, server, smtp_options, config, send_fn
+    url,
+    subject,
+    ref_mid,
+    proxy_options,
+    server,
+    smtp_options,
+    config,
+    send_fn,
+    built=None,
 ):
     """
     Fetch URL, build message, store and optionally send.
@@ -290,9 +336,16 @@ def proxy_fetch_and_store_url(
         smtp_options: SMTP credentials dict
         config: Config with proxy_store_to
         send_fn: Function (options, from_addr, to_addr, message) -> None
+        built: Future already building the message in a worker thread;
+            the message is built inline when None
     """
     try:
-        msg = proxy_build_message_from_url(url, subject, ref_mid, proxy_options, config)
+        if built is None:
+            msg = proxy_build_message_from_url(
+                url, subject, ref_mid, proxy_options, config
+            )
+        else:
+            msg = built.result()
 
         res, data = server.append(
             config.proxy_store_to.encode("ascii"),
@@ -325,12 +378,12 @@ def proxy_fetch_and_store_url(
         traceback.print_exc()
 
 
-def proxy_process_email(ret, server, smtp_options, seen_ids, config, send_fn):
+def proxy_process_email(message, server, smtp_options, seen_ids, config, send_fn):
     """
     Process single email for URL proxying.
 
     Args:
-        ret: Single result from IMAP FETCH
+        message: Raw RFC822 bytes from IMAP FETCH
         server: IMAP connection
         smtp_options: SMTP credentials dict
         seen_ids: Set of processed Message-IDs
@@ -340,36 +393,55 @@ def proxy_process_email(ret, server, smtp_options, seen_ids, config, send_fn):
     Returns:
         Updated seen_ids set
     """
-    if not isinstance(ret, (list, tuple)):
-        return seen_ids
-
-    try:
-        message = ret[1]
-    except IndexError:
-        return seen_ids
-
-    themail = email.parser.Parser().parsestr(message.decode("utf-8"))
+    themail = email.message_from_bytes(message, policy=email_utils.EMAIL_POLICY)
     if not themail:
         return seen_ids
 
-    should_process, seen_ids = email_utils.should_process_message(
-        themail["Message-ID"], seen_ids
-    )
-    if not should_process:
+    get = themail.get
+    themid = get("Message-ID")
+    if not email_utils.should_process_message(themid, seen_ids):
         return seen_ids
 
-    subject = themail["Subject"]
-    themid = themail["Message-ID"]
-    thesender = themail["From"] or themail["Sender"]
+    subject = get("Subject")
+    thesender = get("From") or get("Sender")
 
     print("Proxy URLs for:", thesender)
 
     proxy_options = proxy_parse_options(themail["To"], config, thesender)
     urls = proxy_extract_urls(themail, subject)
 
-    for u in urls:
-        proxy_fetch_and_store_url(
-            u, subject, themid, proxy_options, server, smtp_options, config, send_fn
-        )
+    if not urls:
+        return seen_ids
+
+    # Fetch and build concurrently; IMAP APPEND and SMTP stay on this thread
+    workers = min(len(urls), _PROXY_FETCH_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        builds = [
+            (
+                u,
+                executor.submit(
+                    proxy_build_message_from_url,
+                    u,
+                    subject,
+                    themid,
+                    proxy_options,
+                    config,
+                ),
+            )
+            for u in urls
+        ]
+
+        for u, built in builds:
+            proxy_fetch_and_store_url(
+                u,
+                subject,
+                themid,
+                proxy_options,
+                server,
+                smtp_options,
+                config,
+                send_fn,
+                built=built,
+            )
 
     return seen_ids
@@ -2,6 +2,8 @@
 """
 S-expression based DSL for IMAP query construction.
 Converts composable query expressions to IMAP SEARCH syntax.
+Matching itself happens on the server (case-insensitive substring,
+RFC 3501); nothing here is evaluated per message.
 
 Usage:
     Match(AnyOf(Froms("user@a.com", "user@b.com")))
@@ -10,46 +12,73 @@ Usage:
 """
 
 
-# Combinators
+# Combinators - criteria are plain IMAP SEARCH strings, built eagerly.
+# OR is binary in IMAP, so it stays left-nested; the prefix is written once
+# and the rest is one join: "(OR (OR a b) c)" == "(OR " * 2 + "a " + "b) c" + ")"
 def or_combine(items):
-    def reduce():
-        result = items[0]()
-        for item in items[1:]:
-            result = f"(OR {result} {item()})"
-        return result
+    if len(items) == 1:
+        return items[0]
+    return "(OR " * (len(items) - 1) + items[0] + " " + ") ".join(items[1:]) + ")"
 
-    return reduce
 
+class _Conjunction(str):
+    """Parenthesized AND list that remembers its operands for splicing"""
+
+
+class _Negation(str):
+    """Single-operand NOT that remembers what it negates"""
 
-def and_combine(items):
-    def reduce():
-        result = items[0]()
-        for item in items[1:]:
-            result = f"({result} {item()})"
-        return result
 
-    return reduce
+def and_combine(items):
+    # A parenthesized list is already an AND; splice nested lists into it
+    operands = [
+        x
+        for item in items
+        for x in (item.operands if isinstance(item, _Conjunction) else (item,))
+    ]
+    if len(operands) == 1:
+        return operands[0]
+    result = _Conjunction(f'({" ".join(operands)})')
+    result.operands = operands
+    return result
 
 
 def not_combine(items):
-    return lambda: f'(NOT {" ".join(x() for x in items)})'
+    # IMAP NOT is unary: negate the conjunction of all operands
+    if not items:
+        raise ValueError("Not() needs at least one matcher")
+    item = and_combine(items)
+    if isinstance(item, _Negation):
+        return item.negated
+    result = _Negation(f"(NOT {item})")
+    result.negated = item
+    return result
 
 
-# Field builders - take multiple values, return list of thunks
-def From(*args):
-    return [lambda v=a: f'(FROM "{v}")' for a in args]
+# Field builders - take multiple values, return list of criteria strings
+# Repeated values are dropped (first occurrence wins) so the server
+# does not evaluate the same criterion twice.
+# Values become IMAP quoted strings, so " and \ are backslash-escaped
+_QUOTED_SPECIALS = str.maketrans({'"': '\\"', "\\": "\\\\"})
 
 
-def To(*args):
-    return [lambda v=a: f'(TO "{v}")' for a in args]
+def _field(kind):
+    """Factory: builder for one IMAP SEARCH header key"""
+    opening = f'({kind} "'
 
+    def build(*args):
+        return [
+            f'{opening}{a.translate(_QUOTED_SPECIALS)}")' for a in dict.fromkeys(args)
+        ]
 
-def Cc(*args):
-    return [lambda v=a: f'(CC "{v}")' for a in args]
+    build.__name__ = build.__qualname__ = kind.capitalize()
+    return build
 
 
-def Subject(*args):
-    return [lambda v=a: f'(SUBJECT "{v}")' for a in args]
+From = _field("FROM")
+To = _field("TO")
+Cc = _field("CC")
+Subject = _field("SUBJECT")
 
 
 # Plural aliases - clearer API
@@ -78,7 +107,22 @@ def Not(*args):
 # Final evaluation
 def parseQuery(expr):
     """Convert expression tree to IMAP SEARCH string"""
-    return expr[0]() if len(expr) == 1 else or_combine(expr)()
+    return expr[0] if len(expr) == 1 else or_combine(expr)
 
 
 Match = parseQuery
+
+
+def compile_queries(queries):
+    """
+    Freeze (criteria, handlers) pairs into the form runQueries sends:
+    (charset, criteria_bytes, handlers) triples. ASCII criteria are sent
+    without a charset; anything else is UTF-8 and needs "CHARSET UTF-8"
+    so the server does not reject or misread it. Handler chains become
+    tuples, so nothing about the DSL is left to do once the IDLE loop starts.
+    """
+    compiled = []
+    for criteria, handler_chain in queries:
+        charset = None if criteria.isascii() else b"CHARSET UTF-8"
+        compiled.append((charset, criteria.encode("utf-8"), tuple(handler_chain)))
+    return tuple(compiled)
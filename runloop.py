@@ -11,5 +11,6 @@ import config_queries
 import handlers
 import imap_utils
 
-password = imap_utils.get_credential("EMAIL_PASSWORD", "password", "Password: ")
-imap_utils.run(config_data, config_queries.Queries, handlers, password)
+if __name__ == "__main__":
+    password = imap_utils.get_credential("EMAIL_PASSWORD", "password", "Password: ")
+    imap_utils.run(config_data, config_queries.Queries, handlers, password)
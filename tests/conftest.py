@@ -3,12 +3,6 @@
 Shared test fixtures for email proxy tests.
 """
 
-import sys
-from pathlib import Path
-
-# Ensure project root is importable without pip install
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
 import pytest
 from unittest.mock import Mock
 
@@ -24,9 +18,9 @@ def mock_server():
     return _make_mock_server
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def test_config():
-    """Minimal config object for testing."""
+    """Minimal config object for testing (read-only, built once per run)."""
     class Config:
         mydomain = "@example.com"
         proxy_to = "proxy@example.com"
@@ -3,13 +3,22 @@
 Tests for email_utils.py - email parsing, construction, language detection.
 """
 
+import email
 import email.message
+import email.policy
 import unittest
+from unittest.mock import patch
 
 from ..email_utils import (
+    SeenIds,
     build_message,
+    build_reply_template,
     detect_language,
+    parse_headers,
+    send_via_smtp,
     should_process_message,
+    smtp_session,
+    stamp_reply,
 )
 
 
@@ -18,20 +27,85 @@ class TestShouldProcessMessage(unittest.TestCase):
 
     def test_new_message_should_process(self):
         seen = set()
-        should, new_seen = should_process_message("msg1@domain", seen)
+        should = should_process_message("msg1@domain", seen)
         self.assertTrue(should)
-        self.assertIn("msg1@domain", new_seen)
+        self.assertIn("msg1@domain", seen)
 
     def test_seen_message_should_not_process(self):
         seen = {"msg1@domain"}
-        should, new_seen = should_process_message("msg1@domain", seen)
+        should = should_process_message("msg1@domain", seen)
         self.assertFalse(should)
 
-    def test_original_set_unchanged(self):
+    def test_records_message_id_in_place(self):
         seen = set()
-        _, new_seen = should_process_message("msg1@domain", seen)
-        self.assertEqual(len(seen), 0)
-        self.assertEqual(len(new_seen), 1)
+        should_process_message("msg1@domain", seen)
+        should_process_message("msg1@domain", seen)
+        self.assertEqual(seen, {"msg1@domain"})
+
+    def test_records_plain_string(self):
+        msg = email.message_from_bytes(
+            b"Message-ID: <msg1@domain>\n\nbody", policy=email.policy.default
+        )
+        seen = set()
+        should_process_message(msg["Message-ID"], seen)
+        (recorded,) = seen
+        self.assertIs(type(recorded), str)
+        self.assertEqual(recorded, "<msg1@domain>")
+
+
+class TestSeenIds(unittest.TestCase):
+    """Tests for the size-capped Message-ID window"""
+
+    def test_membership_after_add(self):
+        seen = SeenIds()
+        seen.add("msg1@domain")
+        self.assertIn("msg1@domain", seen)
+        self.assertNotIn("msg2@domain", seen)
+
+    def test_oldest_evicted_beyond_maxlen(self):
+        seen = SeenIds(maxlen=2)
+        for mid in ("a@x", "b@x", "c@x"):
+            seen.add(mid)
+        self.assertEqual(list(seen), ["b@x", "c@x"])
+
+    def test_readding_refreshes_recency(self):
+        seen = SeenIds(maxlen=2)
+        for mid in ("a@x", "b@x", "a@x", "c@x"):
+            seen.add(mid)
+        self.assertEqual(list(seen), ["a@x", "c@x"])
+
+    def test_duplicate_check_refreshes_recency(self):
+        seen = SeenIds(maxlen=2)
+        should_process_message("a@x", seen)
+        should_process_message("b@x", seen)
+        self.assertFalse(should_process_message("a@x", seen))
+        should_process_message("c@x", seen)
+        self.assertIn("a@x", seen)
+        self.assertNotIn("b@x", seen)
+
+    def test_works_with_should_process_message(self):
+        seen = SeenIds(maxlen=1)
+        self.assertTrue(should_process_message("a@x", seen))
+        self.assertFalse(should_process_message("a@x", seen))
+        self.assertTrue(should_process_message("b@x", seen))
+        self.assertEqual(len(seen), 1)
+
+
+class TestParseHeaders(unittest.TestCase):
+    """Tests for header-only parsing of raw messages"""
+
+    def test_reads_headers_with_crlf(self):
+        raw = b"Subject: Hi\r\nContent-Language: de\r\n\r\nX-Not-A-Header: body\r\n"
+        headers = parse_headers(raw)
+
+        self.assertEqual(headers["Subject"], "Hi")
+        self.assertEqual(detect_language(headers, ["en", "de"]), "de")
+        self.assertIsNone(headers["X-Not-A-Header"])
+
+    def test_message_without_body(self):
+        headers = parse_headers(b"Subject: Hi\n")
+
+        self.assertEqual(headers["Subject"], "Hi")
 
 
 class TestDetectLanguage(unittest.TestCase):
@@ -57,6 +131,13 @@ class TestDetectLanguage(unittest.TestCase):
         result = detect_language(msg, ["en", "de"], default="en")
         self.assertEqual(result, "en")
 
+    def test_default_when_header_empty(self):
+        msg = email.message.EmailMessage()
+        msg["Content-Language"] = ""
+
+        result = detect_language(msg, ["en", "de"], default="de")
+        self.assertEqual(result, "de")
+
     def test_default_when_unknown_language(self):
         msg = email.message.EmailMessage()
         msg["Content-Language"] = "fr"
@@ -184,6 +265,54 @@ class TestCreateReplyMessage(unittest.TestCase):
         self.assertGreater(len(serialized), 0)
 
 
+class TestStampReply(unittest.TestCase):
+    """Tests for replies stamped from a pre-built template"""
+
+    def test_matches_build_message(self):
+        template = build_reply_template(
+            from_addr="from@x", body="Grüße, bin weg", reply_to="reply@x"
+        )
+        stamped = stamp_reply(
+            template,
+            subject="Original",
+            to_addr="to@x",
+            subject_prefix="Re:",
+            in_reply_to="<orig@x>",
+        )
+        built = build_message(
+            subject="Original",
+            from_addr="from@x",
+            to_addr="to@x",
+            body="Grüße, bin weg",
+            subject_prefix="Re:",
+            in_reply_to="<orig@x>",
+            reply_to="reply@x",
+            message_id=stamped["Message-ID"],
+        )
+        built.replace_header("Date", stamped["Date"])
+
+        self.assertEqual(stamped.as_bytes(), built.as_bytes())
+
+    def test_without_reply_to_uses_message_id_domain(self):
+        template = build_reply_template(from_addr="from@x", body="Body")
+        stamped = stamp_reply(
+            template, subject="Hi", to_addr="to@x", message_id_domain="bot.x"
+        )
+
+        self.assertNotIn("Reply-To", stamped)
+        self.assertTrue(stamped["Message-ID"].endswith("@bot.x>"))
+        self.assertEqual(stamped.get_content().strip(), "Body")
+
+    def test_template_left_unchanged(self):
+        template = build_reply_template(from_addr="from@x", body="Body")
+        before = template.as_bytes()
+
+        stamp_reply(template, subject="One", to_addr="a@x")
+        stamp_reply(template, subject="Two", to_addr="b@x")
+
+        self.assertEqual(template.as_bytes(), before)
+
+
 class TestCreateForwardMessage(unittest.TestCase):
     """Tests for forward message creation"""
 
@@ -225,6 +354,86 @@ class TestCreateForwardMessage(unittest.TestCase):
         self.assertGreater(len(serialized), 0)
 
 
+class TestDecodePart(unittest.TestCase):
+    """Tests for single MIME part decoding"""
+
+    def test_decodes_declared_charset(self):
+        from ..email_utils import decode_part
+
+        msg = email.message.EmailMessage()
+        msg.set_content("Grüße", charset="iso-8859-1", cte="8bit")
+
+        self.assertEqual(decode_part(msg).strip(), "Grüße")
+
+    def test_falls_back_on_unknown_charset(self):
+        from ..email_utils import decode_part
+
+        msg = email.message.EmailMessage()
+        msg.set_content("plain text")
+        msg.set_param("charset", "x-unknown")
+
+        self.assertEqual(decode_part(msg).strip(), "plain text")
+
+
+class TestSmtpSession(unittest.TestCase):
+    """Tests for SMTP connection reuse"""
+
+    OPTIONS = {"smtp_server": "smtp.x", "smtp_user": "u", "smtp_pass": "p"}
+
+    @patch("smtplib.SMTP_SSL")
+    def test_single_send_opens_and_quits(self, smtp_ssl):
+        send_via_smtp(self.OPTIONS, "from@x", "to@x", "body")
+
+        smtp_ssl.assert_called_once_with("smtp.x")
+        smtp_ssl.return_value.sendmail.assert_called_once_with("from@x", "to@x", "body")
+        smtp_ssl.return_value.quit.assert_called_once()
+
+    @patch("smtplib.SMTP_SSL")
+    def test_session_reuses_one_connection(self, smtp_ssl):
+        smtp_ssl.return_value.noop.return_value = (250, b"OK")
+
+        with smtp_session(self.OPTIONS) as options:
+            send_via_smtp(options, "from@x", "a@x", "one")
+            send_via_smtp(options, "from@x", "b@x", "two")
+            smtp_ssl.return_value.quit.assert_not_called()
+
+        smtp_ssl.assert_called_once()
+        self.assertEqual(smtp_ssl.return_value.sendmail.call_count, 2)
+        smtp_ssl.return_value.quit.assert_called_once()
+
+    @patch("smtplib.SMTP_SSL")
+    def test_session_without_sends_never_connects(self, smtp_ssl):
+        with smtp_session(self.OPTIONS):
+            pass
+
+        smtp_ssl.assert_not_called()
+
+    @patch("smtplib.SMTP_SSL")
+    def test_session_reconnects_when_dropped(self, smtp_ssl):
+        import smtplib
+
+        smtp_ssl.return_value.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+        with smtp_session(self.OPTIONS) as options:
+            send_via_smtp(options, "from@x", "a@x", "one")
+            send_via_smtp(options, "from@x", "b@x", "two")
+
+        self.assertEqual(smtp_ssl.call_count, 2)
+
+
+    @patch("smtplib.SMTP_SSL")
+    def test_session_reconnects_after_connection_reset(self, smtp_ssl):
+        """A reset socket raises OSError, not SMTPException, from noop/quit"""
+        smtp_ssl.return_value.noop.side_effect = ConnectionResetError()
+        smtp_ssl.return_value.quit.side_effect = ConnectionResetError()
+
+        with smtp_session(self.OPTIONS) as options:
+            send_via_smtp(options, "from@x", "a@x", "one")
+            send_via_smtp(options, "from@x", "b@x", "two")
+
+        self.assertEqual(smtp_ssl.call_count, 2)
+        self.assertEqual(smtp_ssl.return_value.sendmail.call_count, 2)
+
 class TestGetDecodedEmailBody(unittest.TestCase):
     """Tests for email body extraction"""
 
@@ -4,8 +4,9 @@ Tests for handlers.py - email handler behavior.
 """
 
 import email
+import functools
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from ..email_utils import build_message
 from ..handlers import (
@@ -16,53 +17,61 @@ from ..handlers import (
     Obnoxious,
     SetFlags,
     SetFlagsAndMove,
+    SetFlagsAndMoveAndExpunge,
     WorkEmail,
+    runQueries,
 )
 
 
+class Config:
+    """Minimal config for testing; tests only read attributes."""
+
+    mydomain = "@example.com"
+    proxy_to = "proxy@example.com"
+
+    # Work email settings
+    work_forward_to = "work@workplace.edu"
+    work_reply_from = "Answermachine <answermachine@example.com>"
+    work_forward_by = "Forwarder <forwarder@example.com>"
+    work_reply = {
+        "en": "Work emails should be sent to work@workplace.edu",
+        "de": "Arbeits-E-Mails bitte an work@workplace.edu senden.",
+    }
+    work_forward_note = {
+        "en": "Forwarded from {sender}",
+        "de": "Weitergeleitet von {sender}",
+    }
+
+    # Obnoxious settings
+    obnoxious_reply_from = "Devnull <devnull@example.com>"
+    obnoxious_reply = {
+        "en": "This is an automated response. Your email has been filtered as unsolicited.",
+        "de": "Dies ist eine automatische Antwort. Ihre E-Mail wurde als unerwünscht eingestuft.",
+    }
+
+    # Proxy settings
+    proxy_send_from = "Proxy <proxy@example.com>"
+    proxy_store_to = "INBOX.Later"
+    kindle_send_from = "Kindle <kindle@example.com>"
+    kindle_send_to = "user@kindle.com"
+
+    # Fetch settings
+    default_fetch_timeout = 30
+    default_max_download_size = 100 * 1024 * 1024
+    default_image_timeout = 10
+    default_max_images = 100
+    deobfuscators = {}
+
+
+_CONFIG = Config()
+
+
 def make_test_config():
-    """Create minimal config object for testing."""
-
-    class Config:
-        mydomain = "@example.com"
-        proxy_to = "proxy@example.com"
-
-        # Work email settings
-        work_forward_to = "work@workplace.edu"
-        work_reply_from = "Answermachine <answermachine@example.com>"
-        work_forward_by = "Forwarder <forwarder@example.com>"
-        work_reply = {
-            "en": "Work emails should be sent to work@workplace.edu",
-            "de": "Arbeits-E-Mails bitte an work@workplace.edu senden.",
-        }
-        work_forward_note = {
-            "en": "Forwarded from {sender}",
-            "de": "Weitergeleitet von {sender}",
-        }
-
-        # Obnoxious settings
-        obnoxious_reply_from = "Devnull <devnull@example.com>"
-        obnoxious_reply = {
-            "en": "This is an automated response. Your email has been filtered as unsolicited.",
-            "de": "Dies ist eine automatische Antwort. Ihre E-Mail wurde als unerwünscht eingestuft.",
-        }
-
-        # Proxy settings
-        proxy_send_from = "Proxy <proxy@example.com>"
-        proxy_store_to = "INBOX.Later"
-        kindle_send_from = "Kindle <kindle@example.com>"
-        kindle_send_to = "user@kindle.com"
-
-        # Fetch settings
-        default_fetch_timeout = 30
-        default_max_download_size = 100 * 1024 * 1024
-        default_image_timeout = 10
-        default_max_images = 100
-        deobfuscators = {}
-
-    return Config()
+    """Return the shared minimal config object for testing."""
+    return _CONFIG
 
 
+@functools.lru_cache(maxsize=None)
 def make_raw_email(
     from_addr="sender@example.com",
     to_addr="recipient@example.com",
@@ -72,7 +81,7 @@ def make_raw_email(
     reply_to=None,
     content_language=None,
 ):
-    """Create raw email bytes for testing."""
+    """Create raw email bytes for testing (memoized; bytes are immutable)."""
     msg = build_message(
         subject=subject,
         from_addr=from_addr,
@@ -184,6 +193,18 @@ class TestCopyHandler(unittest.TestCase):
         self.assertIn(b"2", call_args[1])
         self.assertIn(b"3", call_args[1])
 
+    def test_uses_precomputed_uid_set(self):
+        """Copy uses the uid_set prepared by runQueries when present"""
+        handler = Copy("INBOX.Archive")
+
+        server = Mock()
+        server.uid.return_value = ("OK", [])
+
+        handler(server, [b"1", b"2"], {"uid_set": b"1,2"}, set())
+
+        call_args = server.uid.call_args[0]
+        self.assertEqual(call_args[1], b"1,2")
+
     def test_passes_through_seen_ids(self):
         """Copy returns seen_ids unchanged"""
         handler = Copy("INBOX.Archive")
@@ -215,7 +236,10 @@ class TestWorkEmailHandler(unittest.TestCase):
             subject="Urgent Task",
             message_id="<work123@example.com>",
         )
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        # UID after the literal, as some servers order FETCH items
+        server = make_mock_server(
+            [(b"1 (RFC822 {%d}" % len(raw_email), raw_email), b" UID 1)"]
+        )
 
         handler(server, [b"1"], {}, set())
 
@@ -234,7 +258,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         handler = WorkEmail(config, send_fn=capture_send)
 
         raw_email = make_raw_email(from_addr="boss@workplace.edu")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -253,7 +277,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         handler = WorkEmail(config, send_fn=capture_send)
 
         raw_email = make_raw_email(from_addr="boss@workplace.edu")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -274,7 +298,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         raw_email = make_raw_email(
             from_addr="noreply@workplace.edu", reply_to="actual-boss@workplace.edu"
         )
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -294,7 +318,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         raw_email = make_raw_email(
             from_addr="boss@workplace.edu", content_language="de"
         )
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -313,7 +337,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         handler = WorkEmail(config, send_fn=capture_send)
 
         raw_email = make_raw_email(from_addr="boss@workplace.edu")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -334,25 +358,76 @@ class TestWorkEmailHandler(unittest.TestCase):
         raw_email = make_raw_email(
             from_addr="boss@workplace.edu", message_id="<duplicate@example.com>"
         )
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         _, _, seen_ids = handler(server, [b"1"], {}, set())
         handler(server, [b"1"], {}, seen_ids)
 
         self.assertEqual(len(sent), 2)  # Only one forward + reply pair
 
+    def test_already_seen_message_body_not_fetched(self):
+        """Only headers are fetched when every Message-ID was already seen"""
+        config = make_test_config()
+        handler = WorkEmail(config, send_fn=lambda *args: None)
+
+        raw_email = make_raw_email(message_id="<seen@example.com>")
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
+
+        handler(server, [b"1"], {}, {"<seen@example.com>"})
+
+        server.uid.assert_called_once()
+        self.assertIn("BODY.PEEK", server.uid.call_args[0][2])
+
+    def test_header_fetch_without_uid_falls_back_to_full_fetch(self):
+        """A header response lacking a UID fetches every requested message"""
+        config = make_test_config()
+        handler = WorkEmail(config, send_fn=lambda *args: None)
+
+        raw_email = make_raw_email(message_id="<nouid@example.com>")
+        server = make_mock_server([(b"1 (RFC822", raw_email)])
+
+        _, _, seen_ids = handler(server, [b"1"], {}, set())
+
+        self.assertEqual(server.uid.call_args[0][1:], (b"1", "RFC822"))
+        self.assertIn("<nouid@example.com>", seen_ids)
+
     def test_seen_ids_returned_include_processed_message(self):
         """seen_ids is updated with processed Message-ID"""
         config = make_test_config()
         handler = WorkEmail(config, send_fn=lambda *args: None)
 
         raw_email = make_raw_email(message_id="<tracked@example.com>")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         _, _, seen_ids = handler(server, [b"1"], {}, set())
 
         self.assertIn("<tracked@example.com>", seen_ids)
 
+    def test_handles_non_utf8_payload(self):
+        """Raw 8-bit payloads are parsed as bytes, not decoded as UTF-8"""
+        sent = []
+
+        def capture_send(options, from_addr, to_addr, msg):
+            sent.append({"to": to_addr})
+
+        config = make_test_config()
+        handler = WorkEmail(config, send_fn=capture_send)
+
+        raw_email = (
+            b"From: boss@workplace.edu\r\n"
+            b"Subject: Gr\xfc\xdfe\r\n"
+            b"Message-ID: <latin1@example.com>\r\n"
+            b"Content-Type: text/plain; charset=iso-8859-1\r\n"
+            b"\r\n"
+            b"Sch\xf6ne Gr\xfc\xdfe\r\n"
+        )
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
+
+        handler(server, [b"1"], {}, set())
+
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sent[1]["to"], "boss@workplace.edu")
+
     def test_continues_if_forward_fails(self):
         """Reply is still attempted if forward fails"""
         import smtplib
@@ -368,7 +443,7 @@ class TestWorkEmailHandler(unittest.TestCase):
         handler = WorkEmail(config, send_fn=failing_then_success)
 
         raw_email = make_raw_email(from_addr="boss@workplace.edu")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -393,7 +468,7 @@ class TestObnoxiousHandler(unittest.TestCase):
         def track_uid(*args):
             if args[0] == "STORE":
                 operations.append("delete")
-            return ("OK", [(b"1 (RFC822", raw_email)])
+            return ("OK", [(b"1 (UID 1 RFC822", raw_email)])
 
         server = Mock()
         server.uid.side_effect = track_uid
@@ -415,7 +490,7 @@ class TestObnoxiousHandler(unittest.TestCase):
         handler = Obnoxious(config, send_fn=capture_send)
 
         raw_email = make_raw_email(from_addr="spammer@spam.com")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -434,7 +509,7 @@ class TestObnoxiousHandler(unittest.TestCase):
         handler = Obnoxious(config, send_fn=capture_send)
 
         raw_email = make_raw_email(from_addr="spammer@spam.com", content_language="de")
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         handler(server, [b"1"], {}, set())
 
@@ -454,7 +529,7 @@ class TestObnoxiousHandler(unittest.TestCase):
         raw_email = make_raw_email(
             from_addr="spammer@spam.com", message_id="<spam123@spam.com>"
         )
-        server = make_mock_server([(b"1 (RFC822", raw_email)])
+        server = make_mock_server([(b"1 (UID 1 RFC822", raw_email)])
 
         _, _, seen_ids = handler(server, [b"1"], {}, set())
         handler(server, [b"1"], {}, seen_ids)
@@ -465,11 +540,25 @@ class TestObnoxiousHandler(unittest.TestCase):
 class TestHandlerComposition(unittest.TestCase):
     """Tests for handler composition behavior"""
 
+    def test_move_uses_uid_move_when_supported(self):
+        """Move issues a single UID MOVE when the server advertises MOVE"""
+        handler = Move("INBOX.Archive")
+
+        server = Mock()
+        server.capabilities = ("IMAP4REV1", "IDLE", "MOVE")
+        server.uid.return_value = ("OK", [])
+
+        res, _, _ = handler(server, [b"1", b"2"], {}, set())
+
+        server.uid.assert_called_once_with("MOVE", b"1,2", "INBOX.Archive")
+        self.assertEqual(res, "OK")
+
     def test_move_calls_copy_then_delete(self):
         """Move handler copies to folder then marks deleted"""
         handler = Move("INBOX.Archive")
 
         server = Mock()
+        server.capabilities = ()
         server.uid.return_value = ("OK", [])
 
         handler(server, [b"1", b"2"], {}, set())
@@ -490,6 +579,7 @@ class TestHandlerComposition(unittest.TestCase):
         handler = Move("INBOX.Archive")
 
         server = Mock()
+        server.capabilities = ()
         server.uid.return_value = ("NO", [b"Copy failed"])
 
         res, data, seen = handler(server, [b"1"], {}, set())
@@ -502,6 +592,7 @@ class TestHandlerComposition(unittest.TestCase):
         handler = SetFlagsAndMove(r"(\Seen)", "INBOX.Read")
 
         server = Mock()
+        server.capabilities = ()
         server.uid.return_value = ("OK", [])
 
         handler(server, [b"1"], {}, set())
@@ -513,6 +604,53 @@ class TestHandlerComposition(unittest.TestCase):
         self.assertEqual(calls[0][0][0], "STORE")
         self.assertIn("Seen", calls[0][0][3])
 
+    def test_setflagsandmoveandexpunge_skips_expunge_with_uid_move(self):
+        """Fused handler relies on UID MOVE instead of a separate EXPUNGE"""
+        handler = SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")
+
+        server = Mock()
+        server.capabilities = ("MOVE",)
+        server.uid.return_value = ("OK", [])
+
+        handler(server, [b"1"], {}, set())
+
+        commands = [c[0][0] for c in server.uid.call_args_list]
+        self.assertEqual(commands, ["STORE", "MOVE"])
+        server.expunge.assert_not_called()
+
+    def test_setflagsandmoveandexpunge_expunges_without_uid_move(self):
+        """Fused handler falls back to copy, delete and expunge"""
+        handler = SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")
+
+        server = Mock()
+        server.capabilities = ()
+        server.uid.return_value = ("OK", [])
+        server.expunge.return_value = ("OK", [])
+
+        handler(server, [b"1"], {}, set())
+
+        commands = [c[0][0] for c in server.uid.call_args_list]
+        self.assertEqual(commands, ["STORE", "COPY", "STORE"])
+        server.expunge.assert_called_once()
+
+    def test_setflagsandmoveandexpunge_uses_move_advertised_after_login(self):
+        """MOVE from the post-login CAPABILITY wins over the greeting"""
+        from ..imap_utils import refresh_capabilities
+
+        handler = SetFlagsAndMoveAndExpunge(r"(\Seen)", "INBOX.Read")
+
+        server = Mock()
+        server.capabilities = ("IMAP4REV1",)
+        server.capability.return_value = ("OK", [b"IMAP4rev1 IDLE MOVE"])
+        server.uid.return_value = ("OK", [])
+        refresh_capabilities(server)
+
+        handler(server, [b"1"], {}, set())
+
+        commands = [c[0][0] for c in server.uid.call_args_list]
+        self.assertEqual(commands, ["STORE", "MOVE"])
+        server.expunge.assert_not_called()
+
     def test_handlers_pass_through_seen_ids(self):
         """Handlers correctly pass through and update seen_ids"""
         handler = SetFlags(r"(\Seen)")
@@ -526,5 +664,58 @@ class TestHandlerComposition(unittest.TestCase):
         self.assertEqual(returned_seen, initial_seen)
 
 
+class TestRunQueries(unittest.TestCase):
+    """Tests for the IDLE query loop"""
+
+    def run_cycles(self, search_results, handler_results):
+        """Run two query cycles, return the SEARCH criteria that were sent"""
+        connection = Mock()
+        connection.uid.side_effect = [("OK", [r]) for r in search_results]
+        handler = Mock(side_effect=[(r, [], set()) for r in handler_results])
+        idle_results = [("OK", [b"1 EXISTS"]), ("BYE", None)]
+
+        with patch("imap_utils.idle", side_effect=idle_results):
+            runQueries(connection, [(None, b'(FROM "a@x")', [handler])])
+
+        return [c[0][2] for c in connection.uid.call_args_list]
+
+    def test_first_cycle_searches_whole_mailbox(self):
+        criteria = self.run_cycles([b"4 5", b""], ["OK"])
+
+        self.assertEqual(criteria[0], b'UID 1:* (FROM "a@x")')
+
+    def test_later_cycles_search_only_newer_uids(self):
+        criteria = self.run_cycles([b"4 5", b""], ["OK"])
+
+        self.assertEqual(criteria[1], b'UID 6:* (FROM "a@x")')
+
+    def test_failed_chain_is_searched_again(self):
+        criteria = self.run_cycles([b"4 5", b"4 5"], ["NO", "OK"])
+
+        self.assertEqual(criteria[1], b'UID 1:* (FROM "a@x")')
+
+    def test_sends_compiled_charset(self):
+        connection = Mock()
+        connection.uid.return_value = ("OK", [b""])
+        idle_results = [("BYE", None)]
+
+        with patch("imap_utils.idle", side_effect=idle_results):
+            runQueries(connection, [(b"CHARSET UTF-8", b"(FROM x)", [])])
+
+        self.assertEqual(connection.uid.call_args[0][:2], ("SEARCH", b"CHARSET UTF-8"))
+
+    def test_ignores_highest_uid_below_range(self):
+        """UID 6:* returns the last message even if its UID is lower"""
+        connection = Mock()
+        connection.uid.side_effect = [("OK", [b"5"]), ("OK", [b"5"])]
+        handler = Mock(return_value=("OK", [], set()))
+        idle_results = [("OK", [b"1 EXISTS"]), ("BYE", None)]
+
+        with patch("imap_utils.idle", side_effect=idle_results):
+            runQueries(connection, [(None, b'(FROM "a@x")', [handler])])
+
+        handler.assert_called_once()
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
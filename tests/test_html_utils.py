@@ -4,6 +4,9 @@ Tests for html_utils.py - HTML transformation and sanitization.
 """
 
 import unittest
+from unittest.mock import patch
+
+import lxml.html
 
 
 class TestMakeHtml2TextConverter(unittest.TestCase):
@@ -38,6 +41,17 @@ class TestMakeHtml2TextConverter(unittest.TestCase):
 
         self.assertIn("http://example.com", result)
 
+    def test_ignore_links_drops_urls(self):
+        from ..html_utils import make_html2text_converter
+
+        converter = make_html2text_converter(ignore_links=True)
+        html = '<p>Visit <a href="http://example.com">example</a></p>'
+
+        result = converter.handle(html)
+
+        self.assertIn("example", result)
+        self.assertNotIn("http://example.com", result)
+
     def test_handles_lists(self):
         from ..html_utils import make_html2text_converter
 
@@ -54,8 +68,6 @@ class TestBleachContent(unittest.TestCase):
     """Tests for HTML sanitization"""
 
     def test_output_contains_no_script_tags(self):
-        import lxml.html
-
         from ..html_utils import bleach_content
 
         html = "<html><body><script>alert('xss')</script><p>Safe</p></body></html>"
@@ -68,8 +80,6 @@ class TestBleachContent(unittest.TestCase):
         self.assertIn("Safe", result_str)
 
     def test_output_contains_no_javascript_urls(self):
-        import lxml.html
-
         from ..html_utils import bleach_content
 
         html = '<html><body><a href="javascript:alert(1)">Click</a></body></html>'
@@ -81,8 +91,6 @@ class TestBleachContent(unittest.TestCase):
         self.assertNotIn("javascript:", result_str.lower())
 
     def test_output_contains_no_form_tags(self):
-        import lxml.html
-
         from ..html_utils import bleach_content
 
         html = '<html><body><form action="/steal"><input name="cc"></form></body></html>'
@@ -94,8 +102,6 @@ class TestBleachContent(unittest.TestCase):
         self.assertNotIn("<form", result_str.lower())
 
     def test_preserves_safe_content(self):
-        import lxml.html
-
         from ..html_utils import bleach_content
 
         html = "<html><body><p>Hello</p><a href='http://safe.com'>Link</a></body></html>"
@@ -108,8 +114,6 @@ class TestBleachContent(unittest.TestCase):
         self.assertIn("http://safe.com", result_str)
 
     def test_removes_inline_styles(self):
-        import lxml.html
-
         from ..html_utils import bleach_content
 
         html = '<html><body><p style="color:red">Styled</p></body></html>'
@@ -125,9 +129,12 @@ class TestBleachContent(unittest.TestCase):
 class TestTransformHtmlContent(unittest.TestCase):
     """Tests for HTML transformation pipeline"""
 
-    def test_returns_html_when_as_txt_false(self):
-        import lxml.html
+    def setUp(self):
+        from ..html_utils import clear_transform_cache
 
+        clear_transform_cache()
+
+    def test_returns_html_when_as_txt_false(self):
         from ..html_utils import transform_html_content
 
         html = "<html><body><p>Content</p></body></html>"
@@ -148,8 +155,6 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertIn("<", content)
 
     def test_returns_plain_text_when_as_txt_true(self):
-        import lxml.html
-
         from ..html_utils import transform_html_content
 
         html = "<html><body><p>Content</p></body></html>"
@@ -169,9 +174,26 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertEqual(subtype, "plain")
         self.assertIn("Content", content)
 
-    def test_extracts_title(self):
-        import lxml.html
+    def test_plain_text_folds_typographic_characters(self):
+        from ..html_utils import transform_html_content
+
+        html = "<html><body><p>It\u2019s \u2013 caf\u00e9</p></body></html>"
+        tree = lxml.html.fromstring(html)
+        config = self._make_config()
 
+        content, title, subtype, prefix = transform_html_content(
+            tree,
+            "http://example.com",
+            config,
+            bleach_html=False,
+            include_images=False,
+            as_txt=True,
+            txt_without_links=False,
+        )
+
+        self.assertEqual(content.strip(), "It's - cafe")
+
+    def test_extracts_title(self):
         from ..html_utils import transform_html_content
 
         html = "<html><head><title>My Title</title></head><body><p>Content</p></body></html>"
@@ -191,8 +213,6 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertEqual(title, "My Title")
 
     def test_prefix_indicates_bleach(self):
-        import lxml.html
-
         from ..html_utils import transform_html_content
 
         html = "<html><body><p>Content</p></body></html>"
@@ -212,8 +232,6 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertIn("B", prefix)
 
     def test_prefix_indicates_text_with_links(self):
-        import lxml.html
-
         from ..html_utils import transform_html_content
 
         html = "<html><body><p>Content</p></body></html>"
@@ -233,8 +251,6 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertIn("TL", prefix)
 
     def test_prefix_indicates_text_without_links(self):
-        import lxml.html
-
         from ..html_utils import transform_html_content
 
         html = "<html><body><p>Content</p></body></html>"
@@ -254,8 +270,6 @@ class TestTransformHtmlContent(unittest.TestCase):
         self.assertIn("TP", prefix)
 
     def test_links_removed_when_txt_without_links(self):
-        import lxml.html
-
         from ..html_utils import transform_html_content
 
         html = '<html><body><a href="http://example.com">Link</a></body></html>'
@@ -274,6 +288,79 @@ class TestTransformHtmlContent(unittest.TestCase):
 
         self.assertNotIn("http://example.com", content)
 
+    def test_repeated_document_reuses_result(self):
+        from .. import html_utils
+
+        html = "<html><body><p>Content</p></body></html>"
+        config = self._make_config()
+        args = ("http://example.com", config, True, False, True, False)
+
+        with patch.object(
+            html_utils, "bleach_content", wraps=html_utils.bleach_content
+        ) as bleach:
+            first = html_utils.transform_html_content(lxml.html.fromstring(html), *args)
+            second = html_utils.transform_html_content(lxml.html.fromstring(html), *args)
+
+        self.assertEqual(first, second)
+        bleach.assert_called_once()
+
+    def test_large_document_is_not_memoized(self):
+        from .. import html_utils
+
+        html = "<html><body><p>" + "x" * 200 + "</p></body></html>"
+        config = self._make_config()
+        args = ("http://example.com", config, True, False, True, False)
+
+        with patch.object(html_utils, "_TRANSFORM_CACHE_MAX_ENTRY", 100):
+            html_utils.transform_html_content(lxml.html.fromstring(html), *args)
+
+        self.assertFalse(html_utils._transform_cache)
+
+    def test_cache_evicts_oldest_past_byte_budget(self):
+        from .. import html_utils
+
+        config = self._make_config()
+        args = ("http://example.com", config, False, False, False, False)
+        pages = [f"<html><body><p>page {i}</p></body></html>" for i in range(3)]
+
+        size = len(
+            html_utils.transform_html_content(lxml.html.fromstring(pages[0]), *args)[0]
+        )
+        with patch.object(html_utils, "_TRANSFORM_CACHE_BYTES", 2 * size):
+            for page in pages[1:]:
+                html_utils.transform_html_content(lxml.html.fromstring(page), *args)
+
+        self.assertEqual(len(html_utils._transform_cache), 2)
+        self.assertEqual(html_utils._transform_cache_bytes, 2 * size)
+
+    def test_flags_are_part_of_the_cache_key(self):
+        from ..html_utils import transform_html_content
+
+        html = "<html><body><p>Content</p></body></html>"
+        config = self._make_config()
+
+        as_html = transform_html_content(
+            lxml.html.fromstring(html),
+            "http://example.com",
+            config,
+            bleach_html=False,
+            include_images=False,
+            as_txt=False,
+            txt_without_links=False,
+        )
+        as_txt = transform_html_content(
+            lxml.html.fromstring(html),
+            "http://example.com",
+            config,
+            bleach_html=False,
+            include_images=False,
+            as_txt=True,
+            txt_without_links=False,
+        )
+
+        self.assertEqual(as_html[2], "html")
+        self.assertEqual(as_txt[2], "plain")
+
     def _make_config(self):
         class Config:
             deobfuscators = {}
@@ -283,12 +370,153 @@ class TestTransformHtmlContent(unittest.TestCase):
         return Config()
 
 
+class TestIncludeImagesInTree(unittest.TestCase):
+    """Tests for image inlining"""
+
+    def patch_http(self, fake_fetch):
+        """Bypass the cache, serve fetches from fake_fetch; return the store mock"""
+        patchers = [
+            patch("http_utils.get_cached", return_value=None),
+            patch("http_utils.store_cached"),
+            patch("http_utils.fetch_url", side_effect=fake_fetch),
+        ]
+        mocks = []
+        for patcher in patchers:
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        return mocks[1]
+
+    def test_inlines_fetched_images_and_drops_failures(self):
+        from ..html_utils import include_images_in_tree
+
+        html = (
+            '<html><body><img src="http://x/a.png">'
+            '<img src="http://x/broken.png"><img src="http://x/b.png"></body></html>'
+        )
+        tree = lxml.html.fromstring(html)
+
+        def fake_fetch(src, timeout):
+            if "broken" in src:
+                raise OSError("unreachable")
+            return b"PNG", src, {"content-type": "image/png"}, None
+
+        self.patch_http(fake_fetch)
+        result = include_images_in_tree(tree, timeout=1)
+
+        srcs = [img.get("src") for img in result.xpath("//img")]
+        self.assertEqual(srcs, ["data:image/png;base64,UE5H"] * 2)
+
+    def test_filters_by_parsed_dimensions(self):
+        from ..html_utils import include_images_in_tree
+
+        html = (
+            '<html><body><img src="http://x/pixel.png" width="1.5px" height="1">'
+            '<img src="http://x/big.png" width="300px" height="200.5">'
+            '<img src="http://x/fluid.png" width="100%" height="auto"></body></html>'
+        )
+        tree = lxml.html.fromstring(html)
+        fetched = []
+
+        def fake_fetch(src, timeout):
+            fetched.append(src)
+            return b"PNG", src, {"content-type": "image/png"}, None
+
+        self.patch_http(fake_fetch)
+        include_images_in_tree(tree, timeout=1, workers=1)
+
+        self.assertEqual(fetched, ["http://x/big.png", "http://x/fluid.png"])
+
+    def test_caches_under_redirect_target_only_when_different(self):
+        from ..html_utils import include_images_in_tree
+
+        html = (
+            '<html><body><img src="http://x/a.png"><img src="http://x/moved.png">'
+            "</body></html>"
+        )
+        tree = lxml.html.fromstring(html)
+
+        def fake_fetch(src, timeout):
+            final = src.replace("moved", "b")
+            return b"PNG", final, {"content-type": "image/png"}, None
+
+        store = self.patch_http(fake_fetch)
+        include_images_in_tree(tree, timeout=1)
+
+        self.assertEqual(
+            sorted(call.args[0] for call in store.call_args_list),
+            ["http://x/a.png", "http://x/b.png", "http://x/moved.png"],
+        )
+
+    def test_fetches_repeated_source_once(self):
+        from ..html_utils import include_images_in_tree
+
+        html = (
+            '<html><body><img src="http://x/a.png"><img src="http://x/a.png">'
+            "</body></html>"
+        )
+        tree = lxml.html.fromstring(html)
+        fetched = []
+
+        def fake_fetch(src, timeout):
+            fetched.append(src)
+            return b"PNG", src, {"content-type": "image/png"}, None
+
+        self.patch_http(fake_fetch)
+        result = include_images_in_tree(tree, timeout=1)
+
+        self.assertEqual(fetched, ["http://x/a.png"])
+        srcs = [img.get("src") for img in result.xpath("//img")]
+        self.assertEqual(srcs, ["data:image/png;base64,UE5H"] * 2)
+
+    def test_sources_redirecting_to_same_target_share_cache_entry(self):
+        import os
+        import tempfile
+
+        import config_data
+
+        from ..html_utils import include_images_in_tree
+        from ..http_utils import clear_memory_cache, get_cached
+
+        html = (
+            '<html><body><img src="http://x/a.png"><img src="http://x/b.png">'
+            "</body></html>"
+        )
+        tree = lxml.html.fromstring(html)
+        self.addCleanup(clear_memory_cache)
+
+        def fake_fetch(src, timeout):
+            return b"PNG", "http://x/target.png", {"content-type": "image/png"}, None
+
+        with tempfile.TemporaryDirectory() as tmpdir, patch.object(
+            config_data, "cache_prefix", tmpdir
+        ), patch("http_utils.fetch_url", side_effect=fake_fetch):
+            clear_memory_cache()
+            include_images_in_tree(tree, timeout=1, workers=2)
+            clear_memory_cache()
+
+            self.assertEqual(
+                get_cached("http://x/target.png"), b"data:image/png;base64,UE5H"
+            )
+            self.assertFalse(
+                [name for name in os.listdir(tmpdir) if name.startswith(".tmp-")]
+            )
+
+    def test_drops_images_beyond_max_images(self):
+        from ..html_utils import include_images_in_tree
+
+        html = "<html><body>" + '<img src="http://x/i.png">' * 3 + "</body></html>"
+        tree = lxml.html.fromstring(html)
+
+        with patch("http_utils.get_cached", return_value=b"data:image/png;base64,"):
+            result = include_images_in_tree(tree, max_images=2)
+
+        self.assertEqual(len(result.xpath("//img")), 2)
+
+
 class TestDeobfuscateSpiegel(unittest.TestCase):
     """Tests for Spiegel.de deobfuscation"""
 
     def test_shifts_obfuscated_text_back(self):
-        import lxml.html
-
         from ..html_utils import deobfuscate_spiegel
 
         # Spiegel shifts characters forward by 1, so 'b' becomes 'a'
@@ -300,9 +528,47 @@ class TestDeobfuscateSpiegel(unittest.TestCase):
 
         self.assertIn("hello", result_str)
 
-    def test_leaves_non_obfuscated_content_unchanged(self):
-        import lxml.html
+    def test_shifts_deeply_nested_text_but_not_outer_tail(self):
+        from ..html_utils import deobfuscate_spiegel
+
+        html = (
+            '<html><body><div class="obfuscated"><p><b><i>ifmmp</i>'
+            " xpsme</b></p></div>ifmmp</body></html>"
+        )
+        tree = lxml.html.fromstring(html)
+
+        result = deobfuscate_spiegel(tree)
+        result_str = lxml.html.tostring(result, encoding="unicode")
+
+        self.assertIn("<i>hello</i> world", result_str)
+        self.assertIn("</div>ifmmp", result_str)
 
+    def test_shifts_umlauts_and_leaves_other_text(self):
+        from ..html_utils import deobfuscate_spiegel
+
+        # ý and à are ü and ß shifted by one; é is not part of the alphabet
+        html = '<html><body><div class="obfuscated">Hsýàf dbgé</div></body></html>'
+        tree = lxml.html.fromstring(html)
+
+        result = deobfuscate_spiegel(tree)
+
+        self.assertEqual(result.findtext(".//div"), "Grüße café")
+
+    def test_nested_obfuscated_blocks_shift_once(self):
+        from ..html_utils import deobfuscate_spiegel
+
+        html = (
+            '<html><body><div class="obfuscated">'
+            '<div class="obfuscated">ifmmp</div></div></body></html>'
+        )
+        tree = lxml.html.fromstring(html)
+
+        result = deobfuscate_spiegel(tree)
+        result_str = lxml.html.tostring(result, encoding="unicode")
+
+        self.assertIn(">hello<", result_str)
+
+    def test_leaves_non_obfuscated_content_unchanged(self):
         from ..html_utils import deobfuscate_spiegel
 
         html = "<html><body><p>normal text</p></body></html>"
@@ -318,8 +584,6 @@ class TestApplyDeobfuscation(unittest.TestCase):
     """Tests for deobfuscation dispatch"""
 
     def test_applies_matching_deobfuscator(self):
-        import lxml.html
-
         from ..html_utils import apply_deobfuscation
 
         html = '<html><body><div class="obfuscated"><p>uftu</p></div></body></html>'
@@ -332,8 +596,6 @@ class TestApplyDeobfuscation(unittest.TestCase):
         self.assertIn("test", result_str)
 
     def test_no_change_when_no_matching_deobfuscator(self):
-        import lxml.html
-
         from ..html_utils import apply_deobfuscation
 
         html = "<html><body><p>original</p></body></html>"
@@ -345,6 +607,34 @@ class TestApplyDeobfuscation(unittest.TestCase):
 
         self.assertIn("original", result_str)
 
+    def test_matches_subdomains_of_registered_host(self):
+        from ..html_utils import apply_deobfuscation
+
+        html = '<html><body><div class="obfuscated"><p>uftu</p></div></body></html>'
+        tree = lxml.html.fromstring(html)
+        deobfuscators = {"spiegel.de": "deobfuscate_spiegel"}
+
+        result = apply_deobfuscation(
+            tree, "https://www.spiegel.de/article", deobfuscators
+        )
+        result_str = lxml.html.tostring(result, encoding="unicode")
+
+        self.assertIn("test", result_str)
+
+    def test_ignores_domain_outside_host(self):
+        from ..html_utils import apply_deobfuscation
+
+        html = '<html><body><div class="obfuscated"><p>uftu</p></div></body></html>'
+        tree = lxml.html.fromstring(html)
+        deobfuscators = {"spiegel.de": "deobfuscate_spiegel"}
+
+        result = apply_deobfuscation(
+            tree, "http://other.com/?ref=spiegel.de", deobfuscators
+        )
+        result_str = lxml.html.tostring(result, encoding="unicode")
+
+        self.assertIn("uftu", result_str)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
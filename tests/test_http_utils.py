@@ -3,9 +3,24 @@
 Tests for http_utils.py - HTTP fetching and caching.
 """
 
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
 import unittest
+import urllib.error
+from unittest.mock import Mock, patch
 
-from ..http_utils import get_filename_from_headers_or_url
+from .. import http_utils
+from ..http_utils import (
+    clear_memory_cache,
+    close_idle_connections,
+    fetch_url,
+    get_cached,
+    get_filename_from_headers_or_url,
+    store_cached,
+)
 
 
 class TestGetFilenameFromHeadersOrUrl(unittest.TestCase):
@@ -21,6 +36,19 @@ class TestGetFilenameFromHeadersOrUrl(unittest.TestCase):
         result = get_filename_from_headers_or_url(headers, "http://example.com/other")
         self.assertEqual(result, "report.pdf")
 
+    def test_extracts_unquoted_filename(self):
+        headers = {"content-disposition": "attachment; filename=report.pdf; size=3"}
+        result = get_filename_from_headers_or_url(headers, "http://example.com/other")
+        self.assertEqual(result, "report.pdf")
+
+    def test_prefers_rfc2231_filename(self):
+        headers = {
+            "content-disposition": "attachment; filename=\"fallback.pdf\"; "
+            "filename*=UTF-8'de'Gr%C3%BC%C3%9Fe.pdf"
+        }
+        result = get_filename_from_headers_or_url(headers, "http://example.com/other")
+        self.assertEqual(result, "Grüße.pdf")
+
     def test_falls_back_to_url(self):
         headers = {}
         result = get_filename_from_headers_or_url(
@@ -34,5 +62,282 @@ class TestGetFilenameFromHeadersOrUrl(unittest.TestCase):
         self.assertEqual(result, "download")
 
 
+class TestDiskCache(unittest.TestCase):
+    """Tests for the URL-keyed disk cache"""
+
+    def setUp(self):
+        import config_data
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.original_prefix = config_data.cache_prefix
+        config_data.cache_prefix = self.tmpdir.name
+        clear_memory_cache()
+
+    def tearDown(self):
+        import config_data
+
+        config_data.cache_prefix = self.original_prefix
+        self.tmpdir.cleanup()
+        clear_memory_cache()
+
+    def test_miss_returns_none(self):
+        self.assertIsNone(get_cached("http://example.com/missing"))
+
+    def test_roundtrip(self):
+        store_cached("http://example.com/a", b"content")
+
+        self.assertEqual(get_cached("http://example.com/a"), b"content")
+
+    def test_disk_hit_after_memory_cleared(self):
+        store_cached("http://example.com/a", b"content")
+        clear_memory_cache()
+
+        self.assertEqual(get_cached("http://example.com/a"), b"content")
+
+    def test_migrates_legacy_sha256_entry(self):
+        url = "http://example.com/old"
+        legacy = os.path.join(
+            self.tmpdir.name, hashlib.sha256(url.encode("utf-8")).hexdigest()
+        )
+        with open(legacy, "wb") as f:
+            f.write(b"old content")
+
+        self.assertEqual(get_cached(url), b"old content")
+        self.assertFalse(os.path.exists(legacy))
+
+        clear_memory_cache()
+        self.assertEqual(get_cached(url), b"old content")
+
+    def test_memory_hit_skips_disk(self):
+        store_cached("http://example.com/a", b"content")
+        for name in os.listdir(self.tmpdir.name):
+            os.remove(os.path.join(self.tmpdir.name, name))
+
+        self.assertEqual(get_cached("http://example.com/a"), b"content")
+
+    def test_store_leaves_no_temporary_files(self):
+        store_cached("http://example.com/a", b"content")
+
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+        self.assertFalse(os.listdir(self.tmpdir.name)[0].startswith(".tmp-"))
+
+    def test_failed_write_keeps_previous_entry(self):
+        store_cached("http://example.com/a", b"old")
+        clear_memory_cache()
+
+        with patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                store_cached("http://example.com/a", b"new")
+        clear_memory_cache()
+
+        self.assertEqual(get_cached("http://example.com/a"), b"old")
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Tests for the keep-alive pool limits"""
+
+    def setUp(self):
+        close_idle_connections()
+        self.addCleanup(close_idle_connections)
+
+    def test_global_cap_evicts_least_recently_used_host(self):
+        a, b, c = Mock(), Mock(), Mock()
+        with patch.object(http_utils, "_MAX_IDLE_TOTAL", 2):
+            http_utils._checkin(("http", "a"), a)
+            http_utils._checkin(("http", "b"), b)
+            http_utils._checkin(("http", "c"), c)
+
+        a.close.assert_called_once()
+        b.close.assert_not_called()
+        self.assertEqual(
+            list(http_utils._idle_connections), [("http", "b"), ("http", "c")]
+        )
+
+    def test_expired_connection_is_closed_not_reused(self):
+        stale = Mock()
+        http_utils._checkin(("http", "a"), stale)
+        with patch.object(http_utils, "_IDLE_TIMEOUT", 0):
+            connection, reused = http_utils._checkout(("http", "a"), 1)
+
+        stale.close.assert_called_once()
+        self.assertFalse(reused)
+        self.assertIsNot(connection, stale)
+
+    def test_close_idle_connections_empties_pool(self):
+        idle = Mock()
+        http_utils._checkin(("http", "a"), idle)
+        close_idle_connections()
+
+        idle.close.assert_called_once()
+        self.assertFalse(http_utils._idle_connections)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header("Location", "/page")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/page":
+            body = b"<html>hello</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path in ("/to-file", "/to-data"):
+            self.send_response(302)
+            target = "file:///etc/hostname" if self.path == "/to-file" else "data:,x"
+            self.send_header("Location", target)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/no-location":
+            body = b"not a page"
+            self.send_response(302)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/big-redirect":
+            body = b"x" * (1024 * 1024)
+            self.send_response(302)
+            self.send_header("Location", "/page")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except OSError:
+                pass
+            self.close_connection = True
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"short")
+            self.close_connection = True
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in (b"abcd", b"efgh"):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchUrl(unittest.TestCase):
+    """Tests for fetching over a local keep-alive HTTP server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.ports = []
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_returns_content_and_headers(self):
+        content, base_href, headers, info = fetch_url(self.base + "/page")
+
+        self.assertEqual(content, b"<html>hello</html>")
+        self.assertEqual(base_href, self.base + "/page")
+        self.assertEqual(headers["content-type"], "text/html")
+        self.assertEqual(info.get_content_type(), "text/html")
+
+    def test_follows_redirects(self):
+        content, base_href, _, _ = fetch_url(self.base + "/moved")
+
+        self.assertEqual(content, b"<html>hello</html>")
+        self.assertEqual(base_href, self.base + "/page")
+
+    def test_reuses_connection(self):
+        self.server.ports.clear()
+
+        fetch_url(self.base + "/page")
+        fetch_url(self.base + "/page")
+
+        self.assertEqual(len(set(self.server.ports)), 1)
+
+    def test_environment_proxy_bypasses_pool(self):
+        env = {"http_proxy": "http://proxy.invalid:3128", "no_proxy": ""}
+        with (
+            patch.dict(os.environ, env),
+            patch.object(
+                http_utils.URLOpener, "open", side_effect=urllib.error.URLError("proxy")
+            ) as opener,
+        ):
+            with self.assertRaises(urllib.error.URLError):
+                fetch_url("http://example.invalid/page")
+
+        opener.assert_called_once()
+
+    def test_rejects_redirect_to_file_url(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            fetch_url(self.base + "/to-file")
+
+        self.assertIn("not allowed", str(cm.exception))
+
+    def test_rejects_redirect_to_data_url(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            fetch_url(self.base + "/to-data")
+
+    def test_opens_data_url_given_by_caller(self):
+        content, _, _, _ = fetch_url("data:,x")
+
+        self.assertEqual(content, b"x")
+
+    def test_redirect_without_location_is_an_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            fetch_url(self.base + "/no-location")
+
+        self.assertEqual(cm.exception.code, 302)
+
+    def test_large_redirect_body_is_dropped_not_drained(self):
+        close_idle_connections()
+        self.server.ports.clear()
+
+        content, base_href, _, _ = fetch_url(self.base + "/big-redirect")
+
+        self.assertEqual(content, b"<html>hello</html>")
+        self.assertEqual(base_href, self.base + "/page")
+        # The redirect's connection was closed, so /page needed a new one
+        self.assertEqual(len(set(self.server.ports)), 2)
+
+    def test_truncated_body_raises_url_error(self):
+        with self.assertRaises(urllib.error.URLError) as cm:
+            fetch_url(self.base + "/truncated")
+
+        self.assertNotIsInstance(cm.exception, urllib.error.HTTPError)
+
+    def test_raises_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            fetch_url(self.base + "/missing")
+
+    def test_rejects_oversized_content(self):
+        with self.assertRaises(ValueError):
+            fetch_url(self.base + "/page", max_size=4)
+
+    def test_reads_chunked_body(self):
+        content, _, _, _ = fetch_url(self.base + "/chunked")
+
+        self.assertEqual(content, b"abcdefgh")
+
+    def test_rejects_oversized_chunked_content(self):
+        with self.assertRaises(ValueError):
+            fetch_url(self.base + "/chunked", max_size=6)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
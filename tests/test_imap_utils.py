@@ -4,10 +4,21 @@ Tests for imap_utils.py - IMAP protocol utilities and credentials.
 """
 
 import os
+import socket
 import sys
+import time
 import unittest
+from unittest.mock import Mock, patch
 
-from ..imap_utils import get_credential
+from ..imap_utils import (
+    connect_and_select,
+    enable_keepalive,
+    fetch_headers,
+    get_credential,
+    has_capability,
+    idle,
+    iter_rfc822,
+)
 
 
 class TestGetCredential(unittest.TestCase):
@@ -56,6 +67,191 @@ class TestGetCredential(unittest.TestCase):
         finally:
             sys.argv = original_argv
 
+    def test_prompts_only_once(self):
+        from unittest.mock import patch
+
+        if "TEST_CRED_ONCE" in os.environ:
+            del os.environ["TEST_CRED_ONCE"]
+
+        with patch("getpass.getpass", return_value="typed") as prompt:
+            first = get_credential("TEST_CRED_ONCE", "once", "Prompt: ")
+            second = get_credential("TEST_CRED_ONCE", "once", "Prompt: ")
+
+        self.assertEqual((first, second), ("typed", "typed"))
+        prompt.assert_called_once()
+
+
+class TestIterRfc822(unittest.TestCase):
+    """Tests for FETCH response payload extraction"""
+
+    def test_yields_only_payloads(self):
+        data = [
+            (b"1 (UID 1 RFC822 {3}", b"one"),
+            b")",
+            (b"2 (UID 2 RFC822 {3}", b"two"),
+        ]
+
+        self.assertEqual(list(iter_rfc822(data)), [b"one", b"two"])
+
+    def test_skips_empty_response(self):
+        self.assertEqual(list(iter_rfc822([None])), [])
+
+
+class TestFetchHeaders(unittest.TestCase):
+    """Tests for header-only FETCH"""
+
+    def test_pairs_uids_with_parsed_headers(self):
+        server = Mock()
+        server.uid.return_value = (
+            "OK",
+            [
+                (
+                    b"1 (UID 7 BODY[HEADER.FIELDS (MESSAGE-ID)] {19}",
+                    b"Message-ID: <a@x>\r\n\r\n",
+                ),
+                b")",
+                (
+                    b"2 (UID 9 BODY[HEADER.FIELDS (MESSAGE-ID)] {19}",
+                    b"Message-ID: <b@x>\r\n\r\n",
+                ),
+                b")",
+            ],
+        )
+
+        typ, headers = fetch_headers(server, b"7,9", ("MESSAGE-ID",))
+
+        self.assertEqual(typ, "OK")
+        self.assertEqual([uid for uid, _ in headers], [b"7", b"9"])
+        self.assertEqual(headers[1][1]["Message-ID"], "<b@x>")
+        self.assertIn(
+            "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]", server.uid.call_args[0][2]
+        )
+
+    def test_reads_uid_after_literal(self):
+        server = Mock()
+        server.uid.return_value = (
+            "OK",
+            [
+                (
+                    b"1 (BODY[HEADER.FIELDS (MESSAGE-ID)] {19}",
+                    b"Message-ID: <a@x>\r\n\r\n",
+                ),
+                b" UID 7)",
+            ],
+        )
+
+        typ, headers = fetch_headers(server, b"7", ("MESSAGE-ID",))
+
+        self.assertEqual(headers[0][0], b"7")
+        self.assertEqual(headers[0][1]["Message-ID"], "<a@x>")
+
+    def test_missing_uid_yields_none(self):
+        server = Mock()
+        server.uid.return_value = (
+            "OK",
+            [
+                (
+                    b"1 (BODY[HEADER.FIELDS (MESSAGE-ID)] {19}",
+                    b"Message-ID: <a@x>\r\n\r\n",
+                ),
+                b")",
+            ],
+        )
+
+        typ, headers = fetch_headers(server, b"7", ("MESSAGE-ID",))
+
+        self.assertIsNone(headers[0][0])
+
+    def test_passes_through_failure(self):
+        server = Mock()
+        server.uid.return_value = ("NO", [b"failed"])
+
+        typ, data = fetch_headers(server, b"1", ("MESSAGE-ID",))
+
+        self.assertEqual((typ, data), ("NO", [b"failed"]))
+
+
+class TestIdle(unittest.TestCase):
+    """Tests for IMAP IDLE waiting on the socket"""
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.connection = Mock()
+        self.connection.capabilities = ("IMAP4REV1", "IDLE")
+        self.connection.socket.return_value = self.ours
+        self.connection._command_complete.return_value = ("OK", [b"done"])
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_returns_when_server_sends_data(self):
+        self.theirs.send(b"* 1 EXISTS\r\n")
+
+        start = time.monotonic()
+        typ, _ = idle(self.connection, timeout=5)
+
+        self.assertEqual(typ, "OK")
+        self.assertLess(time.monotonic() - start, 5)
+        self.connection.send.assert_called_once_with(b"DONE\r\n")
+
+    def test_returns_after_timeout(self):
+        typ, _ = idle(self.connection, timeout=0.01)
+
+        self.assertEqual(typ, "OK")
+        self.connection.send.assert_called_once_with(b"DONE\r\n")
+
+    def test_rejects_server_without_idle(self):
+        self.connection.capabilities = ("IMAP4REV1",)
+        self.connection.error = RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            idle(self.connection)
+
+
+class TestConnectAndSelect(unittest.TestCase):
+    """Tests for connection setup"""
+
+    class Config:
+        imap_server = "imap.x"
+        imap_user = "user"
+        inbox = "INBOX"
+
+    @patch("imaplib.IMAP4_SSL")
+    def test_capabilities_refreshed_after_login(self, imap_ssl):
+        connection = imap_ssl.return_value
+        connection.socket.return_value = socket.socket()
+        self.addCleanup(connection.socket.return_value.close)
+        connection.capabilities = ("IMAP4REV1", "AUTH=PLAIN")
+        connection.capability.return_value = ("OK", [b"IMAP4rev1 IDLE MOVE"])
+
+        connection = connect_and_select(self.Config, "secret")
+
+        self.assertTrue(has_capability(connection, "MOVE"))
+        connection.login.assert_called_once_with("user", "secret")
+
+    @patch("imaplib.IMAP4_SSL")
+    def test_keeps_greeting_capabilities_when_refresh_fails(self, imap_ssl):
+        connection = imap_ssl.return_value
+        connection.socket.return_value = socket.socket()
+        self.addCleanup(connection.socket.return_value.close)
+        connection.capabilities = ("IMAP4REV1", "MOVE")
+        connection.capability.return_value = ("NO", [None])
+
+        connection = connect_and_select(self.Config, "secret")
+
+        self.assertTrue(has_capability(connection, "MOVE"))
+
+
+class TestEnableKeepalive(unittest.TestCase):
+    """Tests for TCP keepalive setup"""
+
+    def test_sets_so_keepalive(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            enable_keepalive(sock)
+
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
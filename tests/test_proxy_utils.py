@@ -4,11 +4,13 @@ Tests for proxy_utils.py - URL fetching, option parsing, message building.
 """
 
 import unittest
+from unittest.mock import patch
 
 from ..proxy_utils import (
     proxy_decode_text_content,
     proxy_fix_filename_extension,
     proxy_parse_options,
+    proxy_process_email,
 )
 
 
@@ -104,6 +106,11 @@ class TestProxyDecodeTextContent(unittest.TestCase):
 
         self.assertEqual(result, "Héllo")
 
+    def test_normalizes_mixed_newlines(self):
+        result = proxy_decode_text_content(b"a\r\nb\n\rc\rd\r\n\re", "utf-8")
+
+        self.assertEqual(result, "a\nb\nc\nd\ne")
+
     def test_handles_invalid_encoding_without_crashing(self):
         content = bytes([0x80, 0x81, 0x82])
 
@@ -191,6 +198,33 @@ class TestProxyExtractUrls(unittest.TestCase):
         self.assertIn("http://one.com", urls)
         self.assertIn("http://two.com", urls)
 
+    def test_urls_do_not_run_across_parts(self):
+        import email.message
+
+        from ..proxy_utils import proxy_extract_urls
+
+        msg = email.message.EmailMessage()
+        msg.set_content("First http://one.com")
+        msg.add_alternative("<p>second</p>", subtype="html")
+
+        urls = proxy_extract_urls(msg, "http://two.com")
+
+        self.assertEqual(urls, {"http://one.com", "http://two.com"})
+
+    def test_extracts_urls_from_nested_parts(self):
+        import email.message
+
+        from ..proxy_utils import proxy_extract_urls
+
+        msg = email.message.EmailMessage()
+        msg.set_content("Plain http://one.com")
+        msg.add_alternative("<p>HTML</p>", subtype="html")
+        msg.add_attachment(b"http://binary.com", maintype="application", subtype="pdf")
+
+        urls = proxy_extract_urls(msg, None)
+
+        self.assertEqual(urls, {"http://one.com"})
+
     def test_deduplicates_urls(self):
         import email.message
 
@@ -204,6 +238,30 @@ class TestProxyExtractUrls(unittest.TestCase):
         self.assertIn("http://same.com", urls)
         self.assertEqual(len([u for u in urls if "same.com" in u]), 1)
 
+    def test_collapses_fragment_and_host_case_variants(self):
+        import email.message
+
+        from ..proxy_utils import proxy_extract_urls
+
+        msg = email.message.EmailMessage()
+        msg.set_content("http://Example.com/a#top and HTTP://example.com/a")
+
+        urls = proxy_extract_urls(msg, None)
+
+        self.assertEqual(urls, {"http://example.com/a"})
+
+    def test_keeps_path_and_query_case(self):
+        import email.message
+
+        from ..proxy_utils import proxy_extract_urls
+
+        msg = email.message.EmailMessage()
+        msg.set_content("http://example.com/A?Q=1")
+
+        urls = proxy_extract_urls(msg, None)
+
+        self.assertEqual(urls, {"http://example.com/A?Q=1"})
+
     def test_handles_none_subject(self):
         import email.message
 
@@ -276,7 +334,7 @@ class TestProxyExtractUrls(unittest.TestCase):
 
         self.assertIn("http://example.com/search?q=test&page=1", urls)
 
-    def test_preserves_fragments(self):
+    def test_drops_fragments(self):
         import email.message
 
         from ..proxy_utils import proxy_extract_urls
@@ -286,7 +344,7 @@ class TestProxyExtractUrls(unittest.TestCase):
 
         urls = proxy_extract_urls(msg, None)
 
-        self.assertIn("http://example.com/page#section", urls)
+        self.assertEqual(urls, {"http://example.com/page"})
 
     def test_preserves_port_numbers(self):
         import email.message
@@ -313,5 +371,121 @@ class TestProxyExtractUrls(unittest.TestCase):
         self.assertEqual(len(urls), 0)
 
 
+class TestProxyBuildMessageFromUrl(unittest.TestCase):
+    """Tests for building the proxied message from a fetched page"""
+
+    class Config:
+        deobfuscators = {}
+        default_fetch_timeout = 30
+        default_max_download_size = 1024
+        default_image_timeout = 10
+        default_max_images = 100
+
+    HTML = b'<html><body><p>Text <a href="/rel">link</a></p></body></html>'
+
+    def _build(self, **overrides):
+        import email.message
+
+        from ..proxy_utils import proxy_build_message_from_url
+
+        info = email.message.Message()
+        info["Content-Type"] = "text/html; charset=utf-8"
+        fetched = (self.HTML, "http://x/page", {}, info, "text/html", "html")
+        options = {
+            "as_txt": False,
+            "bleach_html": False,
+            "include_images": False,
+            "txt_without_links": False,
+            "as_inline": True,
+            "send_from": "proxy@x",
+            "send_to": "user@x",
+            **overrides,
+        }
+
+        with patch("http_utils.fetch_and_decode_url", return_value=fetched):
+            return proxy_build_message_from_url(
+                "http://x/page", "Subject", "<m@x>", options, self.Config
+            )
+
+    def test_html_links_made_absolute(self):
+        msg = self._build()
+
+        self.assertIn("http://x/rel", msg.get_content())
+
+    def test_text_without_links_skips_link_resolution(self):
+        import lxml.html
+
+        with patch.object(lxml.html.HtmlMixin, "make_links_absolute") as resolve:
+            msg = self._build(as_txt=True, txt_without_links=True)
+
+        resolve.assert_not_called()
+        self.assertIn("Text link", msg.get_content())
+
+
+class TestProxyProcessEmail(unittest.TestCase):
+    """Tests for per-email proxy processing"""
+
+    class Config:
+        proxy_to = "proxy@example.com"
+        proxy_send_from = "Proxy <proxy@example.com>"
+        kindle_send_from = "Kindle <kindle@example.com>"
+        kindle_send_to = "user@kindle.com"
+        default_fetch_timeout = 30
+        default_max_download_size = 1024
+        proxy_store_to = "INBOX.Proxy"
+
+    RAW = (
+        b"From: sender@x\r\n"
+        b"To: proxy@example.com\r\n"
+        b"Subject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\r\n"
+        b"Message-ID: <m1@x>\r\n"
+        b"Content-Type: text/plain; charset=iso-8859-1\r\n"
+        b"Content-Transfer-Encoding: 8bit\r\n"
+        b"\r\n"
+        b"Gr\xfc\xdfe http://example.com/a\r\n"
+    )
+
+    @patch("http_utils.fetch_and_decode_url", side_effect=OSError("offline"))
+    def test_parses_non_utf8_bytes(self, fetch):
+        seen = set()
+
+        proxy_process_email(self.RAW, None, {}, seen, self.Config, None)
+
+        self.assertIn("<m1@x>", seen)
+        fetch.assert_called_once_with("http://example.com/a", 30, 1024)
+
+    def test_fetches_urls_concurrently_and_appends_each(self):
+        import email.message
+        import threading
+        from unittest.mock import Mock
+
+        raw = self.RAW.replace(
+            b"http://example.com/a", b"http://example.com/a http://example.com/b"
+        )
+        barrier = threading.Barrier(2, timeout=5)
+
+        def fake_fetch(url, timeout, max_size):
+            barrier.wait()  # only passes if both fetches are in flight at once
+            info = email.message.Message()
+            info["Content-Type"] = "text/plain; charset=utf-8"
+            return b"text", url, {}, info, "text/plain", "plain"
+
+        server = Mock()
+        server.append.return_value = ("OK", [b""])
+
+        with patch("http_utils.fetch_and_decode_url", side_effect=fake_fetch):
+            proxy_process_email(raw, server, {}, set(), self.Config, None)
+
+        self.assertEqual(server.append.call_count, 2)
+
+    @patch("http_utils.fetch_and_decode_url")
+    def test_skips_seen_message(self, fetch):
+        seen = {"<m1@x>"}
+
+        proxy_process_email(self.RAW, None, {}, seen, self.Config, None)
+
+        fetch.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
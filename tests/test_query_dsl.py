@@ -3,6 +3,7 @@
 Tests for query_dsl.py - IMAP query DSL.
 """
 
+import re
 import unittest
 
 from ..query_dsl import (
@@ -18,9 +19,13 @@ from ..query_dsl import (
     SubjectPatterns,
     To,
     Tos,
+    compile_queries,
     parseQuery,
 )
 
+# Search key directly after an opening parenthesis
+_KEYWORD = re.compile(r"\(([A-Z]+)")
+
 
 class TestFieldBuilders(unittest.TestCase):
     """Tests for field builder functions"""
@@ -49,18 +54,20 @@ class TestFieldBuilders(unittest.TestCase):
         self.assertIsInstance(result, list)
         self.assertEqual(len(result), 1)
 
-    def test_field_thunks_produce_imap_syntax(self):
-        from_thunk = From("user@domain")[0]
-        self.assertEqual(from_thunk(), '(FROM "user@domain")')
-
-        to_thunk = To("user@domain")[0]
-        self.assertEqual(to_thunk(), '(TO "user@domain")')
+    def test_duplicate_values_collapsed_in_order(self):
+        result = From("a@x", "b@x", "a@x")
+        self.assertEqual(result, ['(FROM "a@x")', '(FROM "b@x")'])
 
-        cc_thunk = Cc("user@domain")[0]
-        self.assertEqual(cc_thunk(), '(CC "user@domain")')
+    def test_fields_produce_imap_syntax(self):
+        self.assertEqual(From("user@domain"), ['(FROM "user@domain")'])
+        self.assertEqual(To("user@domain"), ['(TO "user@domain")'])
+        self.assertEqual(Cc("user@domain"), ['(CC "user@domain")'])
+        self.assertEqual(Subject("test"), ['(SUBJECT "test")'])
 
-        subject_thunk = Subject("test")[0]
-        self.assertEqual(subject_thunk(), '(SUBJECT "test")')
+    def test_combinators_build_strings_eagerly(self):
+        self.assertEqual(
+            AnyOf(From("a@x"), To("b@x")), ['(OR (FROM "a@x") (TO "b@x"))']
+        )
 
 
 class TestPluralAliases(unittest.TestCase):
@@ -112,6 +119,26 @@ class TestCombinators(unittest.TestCase):
         result = Match(AllOf(From("sender@x"), To("recipient@y")))
         self.assertEqual(result, '((FROM "sender@x") (TO "recipient@y"))')
 
+    def test_allof_many_values_is_one_flat_list(self):
+        result = Match(AllOf(From("a@x"), To("b@x"), Cc("c@x"), Subject("d")))
+        self.assertEqual(result, '((FROM "a@x") (TO "b@x") (CC "c@x") (SUBJECT "d"))')
+
+    def test_nested_allof_spliced(self):
+        result = Match(AllOf(From("a@x"), AllOf(To("b@x"), Cc("c@x"))))
+        self.assertEqual(result, '((FROM "a@x") (TO "b@x") (CC "c@x"))')
+
+    def test_not_of_several_negates_their_conjunction(self):
+        result = Match(Not(From("a@x"), To("b@x")))
+        self.assertEqual(result, '(NOT ((FROM "a@x") (TO "b@x")))')
+
+    def test_not_without_matchers_rejected(self):
+        with self.assertRaises(ValueError):
+            Not()
+
+    def test_double_negation_cancels(self):
+        result = Match(Not(Not(From("a@x"))))
+        self.assertEqual(result, '(FROM "a@x")')
+
     def test_not_single_value(self):
         result = Match(Not(From("spam@x")))
         self.assertEqual(result, '(NOT (FROM "spam@x"))')
@@ -241,8 +268,6 @@ class TestIMAPSyntaxValidity(unittest.TestCase):
 
     def test_valid_imap_keywords(self):
         """Ensure only valid IMAP SEARCH keywords are used"""
-        import re
-
         valid_keywords = {"FROM", "TO", "CC", "SUBJECT", "OR", "NOT"}
 
         queries = [
@@ -255,7 +280,7 @@ class TestIMAPSyntaxValidity(unittest.TestCase):
         ]
 
         for query in queries:
-            keywords = re.findall(r"\(([A-Z]+)", query)
+            keywords = _KEYWORD.findall(query)
             for kw in keywords:
                 self.assertIn(kw, valid_keywords, f"Invalid keyword {kw} in: {query}")
 
@@ -289,6 +314,14 @@ class TestEdgeCases(unittest.TestCase):
         result = Match(SubjectPatterns("Re: Your inquiry"))
         self.assertEqual(result, '(SUBJECT "Re: Your inquiry")')
 
+    def test_escapes_quote_in_value(self):
+        result = Match(From('a"b@x'))
+        self.assertEqual(result, '(FROM "a\\"b@x")')
+
+    def test_escapes_backslash_in_value(self):
+        result = Match(SubjectPatterns("c:\\temp"))
+        self.assertEqual(result, '(SUBJECT "c:\\\\temp")')
+
     def test_many_or_values(self):
         addresses = [f"user{i}@domain.com" for i in range(5)]
         result = Match(AnyOf(Froms(*addresses)))
@@ -297,5 +330,22 @@ class TestEdgeCases(unittest.TestCase):
             self.assertIn(addr, result)
 
 
+class TestCompileQueries(unittest.TestCase):
+    """Tests for freezing queries into the form runQueries sends"""
+
+    def test_encodes_criteria_and_freezes_chains(self):
+        handler = object()
+        compiled = compile_queries([(Match(Froms("a@x")), [handler])])
+
+        self.assertEqual(compiled, ((None, b'(FROM "a@x")', (handler,)),))
+
+    def test_non_ascii_criteria_declare_utf8_charset(self):
+        compiled = compile_queries([(Match(Froms("ä@x")), [])])
+
+        self.assertEqual(
+            compiled, ((b"CHARSET UTF-8", '(FROM "ä@x")'.encode("utf-8"), ()),)
+        )
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)